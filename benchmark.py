@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+"""
+An offline benchmark of the patcher's own orchestration overhead.
+It runs patch.py against stand-in java and apkmd executables and a local HTTP
+server emulating the GitHub releases API, so no network or JVM is needed.
+Run "python benchmark.py --help" to see the configurable latencies and sizes.
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+scriptDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+sys.path.insert(0, scriptDir)
+import patch
+
+# The stand-in java: answers the java version probe, list-patches and patch commands,
+# and the JVM worker protocol. Every started process is appended to the log.
+fakeJava = r'''
+import os, shutil, sys, time
+args = sys.argv[1:]
+with open(os.environ['BENCH_LOG'], 'a') as log:
+    log.write('java\n')
+args = [i for i in args if not i.startswith('-Xmx')]
+if '-version' in args:
+    sys.stderr.write('    java.class.version = 65.0\n')
+    sys.exit(0)
+time.sleep(float(os.environ['BENCH_JAVA_STARTUP']))
+
+def run(cmd, out):
+    if cmd[0] == 'list-patches':
+        time.sleep(float(os.environ['BENCH_LIST_DELAY']))
+        packages = os.environ['BENCH_PACKAGES'].split(',')
+        for index in range(int(os.environ['BENCH_LIST_SIZE'])):
+            package = packages[index % len(packages)]
+            out.write('Index: {0}\nName: Patch {0}\nDescription: A stand-in patch\nEnabled: true\n'.format(index))
+            out.write('Compatible packages:\n\tPackage name: {}\n\tCompatible versions:\n'.format(package))
+            out.write('\t\t1.{}.0\n\t\t1.{}.1\n'.format(index % 7, index % 7))
+        return 0
+    if cmd[0] == 'patch':
+        time.sleep(float(os.environ['BENCH_PATCH_DELAY']))
+        outPath = next(i for i in cmd if i.startswith('--out='))[len('--out='):]
+        out.write('INFO: Decoding resources\nINFO: "Stand-in patch" succeeded\nINFO: Signing APK\n')
+        shutil.copyfile(cmd[-1], outPath)
+        return 0
+    return 2
+
+if any(i.endswith('PatchWorker.java') for i in args):
+    print('READY', flush=True)
+    for line in sys.stdin:
+        parts = line.rstrip('\n').split('\t')
+        out = open(parts[0], 'w') if parts[0] else sys.stderr
+        status = run(parts[1:], out)
+        out.flush()
+        if parts[0]:
+            out.close()
+        sys.stderr.write('PatchWorker: END\n')
+        sys.stderr.flush()
+        print('DONE {}'.format(status), flush=True)
+    sys.exit(0)
+sys.exit(run(args[2:], sys.stdout))
+'''
+
+# The stand-in apkmd: writes the requested APKs after a delay.
+fakeApkmd = r'''
+import json, os, sys, time
+with open(os.environ['BENCH_LOG'], 'a') as log:
+    log.write('apkmd\n')
+with open(sys.argv[1]) as file:
+    config = json.load(file)
+time.sleep(float(os.environ['BENCH_DOWNLOAD_DELAY']) * len(config['apps']))
+for app in config['apps']:
+    with open(app['outFile'] + '.apk', 'wb') as file:
+        file.write(os.urandom(int(os.environ['BENCH_APK_SIZE'])))
+'''
+
+class FakeGithub(http.server.ThreadingHTTPServer):
+    '''A local stand-in for the GitHub releases API and its asset downloads.
+    The API answers with rate limit headers, and with 403 once the rate limit is used up in a window.'''
+
+    def __init__(self, latency, assetSize, apkmdPath, rateLimit = 0, rateWindow = 2.0):
+        super().__init__(('127.0.0.1', 0), FakeGithubHandler)
+        self.latency = latency
+        self.requests = 0
+        self.rateLimit = rateLimit
+        self.rateWindow = rateWindow
+        self.rateReset = 0.0
+        self.rateUsed = 0
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.releases = {}
+        for source in patch.patchSources.values():
+            for tool in ('cli', 'patches', 'integrations'):
+                if tool in source:
+                    name = '{}-{}-1.0.0.{}'.format(source['subdir'].lower(), tool, 'apk' if tool == 'integrations' else 'jar')
+                    contentType = source[tool]['type'].split('|')[0].replace('\\', '')
+                    self.__addAsset(source[tool]['proj'], name, contentType, os.urandom(assetSize))
+        with open(apkmdPath, 'rb') as file:
+            apkmd = file.read()
+        for name in ('apkmd', 'apkmd.exe'):
+            self.__addAsset('tanishqmanuja/apkmirror-downloader', name, 'application/octet-stream', apkmd)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def __addAsset(self, project, name, contentType, data):
+        self.assets['/download/{}/{}'.format(project, name)] = data
+        self.releases.setdefault(project, {'tag_name': 'v1.0.0', 'assets': []})['assets'].append({
+            'name': name,
+            'content_type': contentType,
+            'size': len(data),
+            'digest': 'sha256:' + hashlib.sha256(data).hexdigest(),
+            'browser_download_url': 'http://127.0.0.1:{}/download/{}/{}'.format(self.server_address[1], project, name)
+        })
+
+class FakeGithubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        status, body, headers = 404, b'', {}
+        parts = self.path.split('/')
+        if self.path.startswith('/repos/') and len(parts) >= 6:
+            release = self.server.releases.get('/'.join(parts[2:4]))
+            headers = self.__rateLimitHeaders()
+            if self.server.rateLimit and self.server.rateUsed > self.server.rateLimit:
+                status, body = 403, b'{"message": "API rate limit exceeded"}'
+            elif release:
+                body = json.dumps(release).encode()
+                etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+                status = 304 if self.headers.get('If-None-Match') == etag else 200
+                if status == 200:
+                    headers['ETag'] = etag
+                else:
+                    body = b''
+        elif self.path in self.server.assets:
+            status, body = 200, self.server.assets[self.path]
+            ranged = self.headers.get('Range')
+            if ranged:
+                status, body = 206, body[int(ranged[len('bytes='):].rstrip('-')):]
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __rateLimitHeaders(self):
+        '''Counts an API request in the current rate limit window, and returns the rate limit headers'''
+        server = self.server
+        limit = server.rateLimit or 5000
+        with server.lock:
+            if time.time() >= server.rateReset:
+                server.rateReset = time.time() + server.rateWindow
+                server.rateUsed = 0
+            server.rateUsed += 1
+            return {
+                'X-RateLimit-Limit': str(limit),
+                'X-RateLimit-Remaining': str(max(0, limit - server.rateUsed)),
+                'X-RateLimit-Reset': str(int(server.rateReset + 0.999)),
+                'X-RateLimit-Used': str(min(limit, server.rateUsed))
+            }
+
+def writeExecutable(path, source):
+    with open(path, 'w') as file:
+        file.write('#!{}\n'.format(sys.executable) + source)
+    os.chmod(path, 0o755)
+
+def runScenario(name, workDir, server, env, inputs, extraArgs, fresh):
+    '''Runs patch.py once, returns the wall time and the number of processes and HTTP requests'''
+    toolsDir = os.path.join(workDir, 'tools')
+    outDir = tempfile.mkdtemp(dir=workDir, prefix='out-')
+    if fresh:
+        shutil.rmtree(toolsDir, ignore_errors=True)
+    logPath = os.path.join(workDir, 'processes.log')
+    open(logPath, 'w').close()
+    with server.lock:
+        server.requests = 0
+    cmd = [
+        sys.executable, os.path.join(scriptDir, 'patch.py'), *inputs,
+        '--toolsDir', toolsDir, '--outDir', outDir, '--optionsDir', os.path.join(workDir, 'options'),
+        '--keystore', os.path.join(workDir, 'bench.keystore'),
+        '--github-api', 'http://127.0.0.1:{}'.format(server.server_address[1]), *extraArgs]
+    startTime = time.perf_counter()
+    result = subprocess.run(
+        cmd, env=dict(env, BENCH_LOG=logPath), cwd=workDir,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - startTime
+    with open(logPath) as file:
+        processes = file.read().split()
+    shutil.rmtree(outDir, ignore_errors=True)
+    if result.returncode != 0:
+        print('### Scenario "{}" failed:\n{}'.format(name, result.stdout.decode(errors='replace')))
+    return {
+        'scenario': name,
+        'seconds': round(seconds, 3),
+        'java': processes.count('java'),
+        'apkmd': processes.count('apkmd'),
+        'httpRequests': server.requests,
+        'exitCode': result.returncode
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher Benchmark',
+        description='Measures the overhead of patch.py with stand-in tools, without network or JVM.')
+    parser.add_argument('--java-startup', type=float, default=0.5, help='Seconds each java process takes to start (default: %(default)s)')
+    parser.add_argument('--list-delay', type=float, default=0.5, help='Seconds list-patches takes to load the bundle (default: %(default)s)')
+    parser.add_argument('--patch-delay', type=float, default=1.0, help='Seconds one patch command takes (default: %(default)s)')
+    parser.add_argument('--download-delay', type=float, default=0.5, help='Seconds apkmd takes per APK (default: %(default)s)')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='Seconds the GitHub stand-in takes per request (default: %(default)s)')
+    parser.add_argument('--rate-limit', type=int, default=0, help='GitHub API requests allowed per rate limit window, 0 for unlimited (default: %(default)s)')
+    parser.add_argument('--rate-window', type=float, default=2.0, help='Seconds of each GitHub API rate limit window (default: %(default)s)')
+    parser.add_argument('--asset-size', type=int, default=1 << 20, help='Bytes of each tool asset (default: %(default)s)')
+    parser.add_argument('--apk-size', type=int, default=1 << 20, help='Bytes of each APK (default: %(default)s)')
+    parser.add_argument('--list-size', type=int, default=500, help='Number of patches listed by list-patches (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', default='1', help='The --jobs value passed to patch.py (default: %(default)s)')
+    parser.add_argument('--scenario', action='append', help='Run only the named scenarios (default: all)')
+    parser.add_argument('--json', help='Write the results as JSON to this path')
+    args = parser.parse_args()
+
+    if os.name != 'posix':
+        print('### The benchmark needs a POSIX system for its stand-in executables.')
+        exit(1)
+    workDir = tempfile.mkdtemp(prefix='patch-benchmark-')
+    try:
+        binDir = os.path.join(workDir, 'bin')
+        os.makedirs(binDir)
+        writeExecutable(os.path.join(binDir, 'java'), fakeJava)
+        writeExecutable(os.path.join(workDir, 'apkmd'), fakeApkmd)
+        server = FakeGithub(
+            args.api_latency, args.asset_size, os.path.join(workDir, 'apkmd'), args.rate_limit, args.rate_window)
+        env = dict(
+            os.environ,
+            PATH=binDir + os.pathsep + os.environ.get('PATH', ''),
+            BENCH_JAVA_STARTUP=str(args.java_startup),
+            BENCH_LIST_DELAY=str(args.list_delay),
+            BENCH_PATCH_DELAY=str(args.patch_delay),
+            BENCH_DOWNLOAD_DELAY=str(args.download_delay),
+            BENCH_APK_SIZE=str(args.apk_size),
+            BENCH_LIST_SIZE=str(args.list_size),
+            BENCH_PACKAGES=','.join(i['package'] for i in patch.appMap.values()))
+
+        appNames = sorted(patch.appMap.keys())
+        srcDir = os.path.join(workDir, 'src')
+        os.makedirs(srcDir)
+        def inputs(count, files = 0):
+            '''Returns app names, followed by local APK files once the app names run out'''
+            names = appNames[:count - files]
+            paths = []
+            for i in range(count - len(names)):
+                path = os.path.join(srcDir, 'Local App {} 1.0.{}.apk'.format(i, i))
+                if not os.path.exists(path):
+                    with open(path, 'wb') as file:
+                        file.write(os.urandom(args.apk_size))
+                paths.append(path)
+            return names + paths
+
+        jobArgs = ['--jobs', args.jobs]
+        scenarios = [
+            ('cold start, 1 app', inputs(1), jobArgs, True),
+            ('warm start, 1 app', inputs(1), jobArgs, False),
+            ('warm start, 1 app, offline', inputs(1), jobArgs + ['--offline'], False),
+            ('warm start, 10 apps', inputs(10), jobArgs, False),
+            ('warm start, 50 apps', inputs(50), jobArgs, False),
+            ('warm start, 5 apps + 5 files', inputs(10, files=5), jobArgs, False),
+            ('warm start, 10 apps, JVM worker', inputs(10), jobArgs + ['--jvm-worker'], False),
+        ]
+        results = []
+        print('### {:<36} {:>9} {:>6} {:>6} {:>6}'.format('Scenario', 'Wall s', 'java', 'apkmd', 'HTTP'))
+        for name, scenarioInputs, extraArgs, fresh in scenarios:
+            if args.scenario and name not in args.scenario:
+                continue
+            result = runScenario(name, workDir, server, env, scenarioInputs, extraArgs, fresh)
+            results.append(result)
+            print('### {:<36} {:>9.2f} {:>6} {:>6} {:>6}'.format(
+                name, result['seconds'], result['java'], result['apkmd'], result['httpRequests']))
+        server.shutdown()
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(results, file, indent=1)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
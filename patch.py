@@ -21,7 +21,24 @@ settings = {
         'arch': 'arm64-v8a',                                # The architecture of downloaded APKs: armeabi-v7a or arm64-v8a or x86 or x86_64.
         'dpi': 'nodpi'                                      # The DPI of the downloaded APIs: 240dpi, 320dpi, ...
     },
-    'defaultPatchSource': 'rv'                              # Select whether the default provider should be ReVanced or ReVancedExtended
+    'defaultPatchSource': 'rv',                             # Select whether the default provider should be ReVanced or ReVancedExtended
+    'githubApi': 'https://api.github.com',                  # The GitHub API from which tool releases are looked up
+    'releaseCacheTtl': 3600,                                # Seconds for which looked up tool releases are reused without a request
+    'githubMaxWait': 900,                                   # The longest wait in seconds for the GitHub rate limit to reset, before failing
+    'jvmWorker': False,                                     # Run the patch tools in resident JVMs instead of one java process per call
+    'apkCache': None,                                       # The directory to keep downloaded APKs in (None for the 'apks' subdirectory of the tools dir)
+    'apkCacheSize': 2048,                                   # The disk budget of the downloaded APK cache in MiB (0 to disable the cache)
+    'memoryEstimate': 2048,                                 # MiB of peak memory assumed for patching an app that was not patched before
+    'memoryReserve': 1024,                                  # MiB of available memory left to the system by concurrent patch jobs
+    'watchSettle': 2.0,                                     # Seconds for which a watched APK must stay unchanged before it is patched
+    'watchPollInterval': 5.0,                               # Seconds between directory scans when watching without inotify
+    'toolStoreSize': 2048,                                  # The disk budget in MiB of the tool store, which keeps all downloaded tool versions
+    'mirror': None,                                         # A local release mirror to provision the tools from instead of GitHub (None to use GitHub)
+    'preflight': True,                                      # Check the package and version of local APKs against the patches before patching
+    'scratchDirs': [],                                      # Directories for temporary files, fastest first, e.g. '/dev/shm' (the system temp dir is the fallback)
+    'scratchMultiplier': 6,                                 # The free scratch space needed by a patch job, as a multiple of its APK size
+    'leaseTimeout': 300,                                    # Seconds without a heartbeat after which a queued job of a dead worker is retried
+    'queuePollInterval': 2.0                                # Seconds between the queue scans of the coordinator and the idle workers
 }
 # This map configures usable patch sources.
 # * rv defines ReVanced, rvx defines ReVanced Extended.
@@ -86,6 +103,11 @@ patchSources = {
         'prepend': 'Morphe '
     }
 }
+# The tool which downloads the APKs of the apps
+apkmdTool = {
+    'proj': 'tanishqmanuja/apkmirror-downloader',
+    'name_filter': 'apkmd.exe' if os.name == 'nt' else 'apkmd' if os.name == 'posix' else None
+}
 # This map helps the auto-downloader interface
 # org and repo define an APKMirror link
 # arch is an override for the preferred arch setting
@@ -288,22 +310,1705 @@ appMap = {
 }
 
 import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import ctypes.util
+import datetime
 import glob
+import hashlib
+import http.client
+import io
 import json
+import pathlib
+import queue
 import re
+import select
 import shutil
+import socket
 import subprocess
 import tempfile
 import textwrap
+import ssl
+import struct
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import zipfile
+
+_printLock = threading.Lock()
+_hashMemo = collections.OrderedDict()
+_hashLock = threading.Lock()
+_hashMemoSize = 4096 # The memoized hashes are evicted in least recently used order above this count
+
+def _memoizeHash(memoKey, digest):
+    '''Memoizes a file hash, the lock must be held'''
+    _hashMemo[memoKey] = digest
+    _hashMemo.move_to_end(memoKey)
+    while len(_hashMemo) > _hashMemoSize:
+        _hashMemo.popitem(last=False)
+
+def printLocked(message):
+    '''Prints a line as one write, so the lines of concurrent threads do not interleave'''
+    with _printLock:
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+def fileHash(path):
+    '''Returns the SHA-256 hex digest of a file, memoized by its size and modification time'''
+    stat = os.stat(path)
+    memoKey = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hashLock:
+        if memoKey in _hashMemo:
+            _hashMemo.move_to_end(memoKey)
+            return _hashMemo[memoKey]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    with _hashLock:
+        _memoizeHash(memoKey, digest.hexdigest())
+        return _hashMemo[memoKey]
+
+def readApkManifest(path):
+    '''Returns the package name and version name of an APK, decoded from its binary AndroidManifest.xml.
+    Only the manifest entry is read from the zip. The version is None if it is not a plain string.'''
+    with zipfile.ZipFile(path) as apk:
+        data = apk.read('AndroidManifest.xml')
+
+    def readStrings(offset, headerSize):
+        count, _, flags, stringsStart, _ = struct.unpack_from('<IIIII', data, offset + 8)
+        strings = []
+        for index in range(count):
+            position = offset + stringsStart + struct.unpack_from('<I', data, offset + headerSize + index * 4)[0]
+            if flags & 0x100:
+                # UTF-8: the length in UTF-16 units, then in bytes, each 1 or 2 bytes long
+                position += 2 if data[position] & 0x80 else 1
+                length = data[position]
+                if length & 0x80:
+                    length = (length & 0x7F) << 8 | data[position + 1]
+                    position += 1
+                strings.append(data[position + 1:position + 1 + length].decode('utf-8', 'replace'))
+            else:
+                length = struct.unpack_from('<H', data, position)[0]
+                if length & 0x8000:
+                    length = (length & 0x7FFF) << 16 | struct.unpack_from('<H', data, position + 2)[0]
+                    position += 2
+                strings.append(data[position + 2:position + 2 + length * 2].decode('utf-16-le', 'replace'))
+        return strings
+
+    chunkType, headerSize, _ = struct.unpack_from('<HHI', data, 0)
+    if chunkType != 0x0003:
+        raise ValueError('The manifest is not a binary XML document.')
+    strings = []
+    resourceIds = []
+    offset = headerSize
+    while offset + 8 <= len(data):
+        chunkType, headerSize, chunkSize = struct.unpack_from('<HHI', data, offset)
+        if chunkSize < 8:
+            break
+        if chunkType == 0x0001: # String pool
+            strings = readStrings(offset, headerSize)
+        elif chunkType == 0x0180: # Resource ids of the attribute names
+            resourceIds = struct.unpack_from('<{}I'.format((chunkSize - headerSize) // 4), data, offset + headerSize)
+        elif chunkType == 0x0102: # Start of an element, the first one is <manifest>
+            _, _, attributeStart, attributeSize, attributeCount = struct.unpack_from('<IIHHH', data, offset + headerSize)
+            attributes = {}
+            for index in range(attributeCount):
+                _, name, rawValue, _, _, dataType, value = struct.unpack_from(
+                    '<IIIHBBI', data, offset + headerSize + attributeStart + index * attributeSize)
+                # Obfuscated manifests may rename the attributes, but keep their resource ids
+                if name < len(resourceIds) and resourceIds[name] == 0x0101021c:
+                    name = 'versionName'
+                else:
+                    name = strings[name]
+                if rawValue != 0xFFFFFFFF:
+                    attributes[name] = strings[rawValue]
+                elif dataType == 0x03:
+                    attributes[name] = strings[value]
+            return attributes.get('package'), attributes.get('versionName')
+        offset += chunkSize
+    raise ValueError('The manifest has no manifest element.')
+
+class CliOutputParser:
+    '''Timestamps the lines printed by the patch CLI, and derives the duration of its phases and patches from them'''
+    # The first phase whose expression matches a line starts with it, other lines continue the current phase
+    phaseMarkers = [
+        ('load', re.compile(r'Loading patches|Setting up|Initializing|Merging')),
+        ('decode', re.compile(r'Decod|Reading')),
+        ('patch', re.compile(r'Executing patches|Applying patches|Running patches')),
+        ('compile', re.compile(r'Compiling|Writing|Rebuilding|Building')),
+        ('sign', re.compile(r'Aligning|Signing|Saved'))
+    ]
+    patchEvent = re.compile(r'"(?P<name>[^"]+)" (?P<status>succeeded|failed)')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def Feed(self, line):
+        with self.lock:
+            self.events.append((time.perf_counter() - self.started, line.rstrip('\r\n')))
+
+    def Timings(self):
+        '''Returns the seconds spent in each phase, and the seconds and status of each patch.
+        A patch takes the time since the previous patch event, as the CLI only logs their results.'''
+        end = time.perf_counter() - self.started
+        with self.lock:
+            events = list(self.events)
+        phases = {}
+        patches = {}
+        phase, phaseStart, patchStart = 'startup', 0.0, 0.0
+        for at, line in events:
+            match = CliOutputParser.patchEvent.search(line)
+            newPhase = 'patch' if match else next(
+                (name for name, regex in CliOutputParser.phaseMarkers if regex.search(line)), phase)
+            if newPhase != phase:
+                phases[phase] = phases.get(phase, 0.0) + at - phaseStart
+                phase, phaseStart = newPhase, at
+                patchStart = at
+            if match:
+                patches[match['name']] = {'seconds': round(at - patchStart, 3), 'status': match['status']}
+                patchStart = at
+        phases[phase] = phases.get(phase, 0.0) + end - phaseStart
+        return {'phases': {i: round(j, 3) for i, j in phases.items()}, 'patches': patches}
+
+class RunReport:
+    '''Collects the timing and resource usage of the run's stages. The stages of a Job are also collected in the job.
+    A long-lived process may set keepStages to False to only collect them in the jobs,
+    or keep only the latest maxStages, which the summary and the written report are then limited to.'''
+    longRunStages = 1000 # The stages kept by a watching or working run
+
+    def __init__(self, keepStages = True, maxStages = None):
+        self.started = time.time()
+        self.keepStages = keepStages
+        self.stages = collections.deque(maxlen=maxStages)
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def Stage(self, stage, subject = None):
+        '''Times a stage of the run. The yielded record collects the stage's child processes.'''
+        record = {
+            'stage': stage, 'subject': subject, 'start': round(time.time() - self.started, 3),
+            'processes': 0, 'cpuSeconds': 0.0, 'peakRssMiB': None}
+        startTime = time.perf_counter()
+        try:
+            yield record
+            record.setdefault('status', 'ok')
+        except BaseException:
+            record['status'] = 'error'
+            raise
+        finally:
+            record['seconds'] = round(time.perf_counter() - startTime, 3)
+            job = Job.Current()
+            if job:
+                job.stages.append(record)
+            if self.keepStages:
+                with self.lock:
+                    self.stages.append(record)
+
+    def Summary(self):
+        '''Returns the stage totals: count, seconds, longest seconds, child CPU seconds and peak RSS'''
+        summary = {}
+        with self.lock:
+            stages = list(self.stages)
+        for record in stages:
+            total = summary.setdefault(record['stage'], {
+                'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0, 'cpuSeconds': 0.0, 'peakRssMiB': None})
+            total['count'] += 1
+            total['seconds'] = round(total['seconds'] + record['seconds'], 3)
+            total['maxSeconds'] = max(total['maxSeconds'], record['seconds'])
+            total['cpuSeconds'] = round(total['cpuSeconds'] + record['cpuSeconds'], 3)
+            if record['peakRssMiB'] is not None:
+                total['peakRssMiB'] = max(total['peakRssMiB'] or 0, record['peakRssMiB'])
+        return summary
+
+    def PrintSummary(self):
+        print('### {:<16} {:>5} {:>9} {:>9} {:>9} {:>13}'.format(
+            'Stage', 'Count', 'Total s', 'Max s', 'CPU s', 'Peak RSS MiB'))
+        for stage, total in self.Summary().items():
+            print('### {:<16} {:>5} {:>9.2f} {:>9.2f} {:>9.2f} {:>13}'.format(
+                stage, total['count'], total['seconds'], total['maxSeconds'], total['cpuSeconds'],
+                '-' if total['peakRssMiB'] is None else '{:.0f}'.format(total['peakRssMiB'])))
+        print('### Total run time: {:.2f}s'.format(time.time() - self.started))
+
+    def PrintStartup(self):
+        '''Prints the time spent before the first patch job, and whether the probes were cached'''
+        with self.lock:
+            stages = list(self.stages)
+        firstJob = min((i['start'] for i in stages if i['stage'] in ('Patch', 'Download')), default=None)
+        probes = ', '.join(
+            '{}: {} ({:.0f} ms)'.format(i['stage'], 'cached' if i['cached'] else 'probed', i['seconds'] * 1000)
+            for i in stages if 'cached' in i)
+        if firstJob is None:
+            print('### No patch job was started. ({})'.format(probes))
+        else:
+            print('### Startup took {:.0f} ms until the first job. ({})'.format(firstJob * 1000, probes))
+
+    def PatchTimes(self):
+        '''Returns the phase and patch durations of each patched app, by package where it is known'''
+        with self.lock:
+            stages = list(self.stages)
+        return {
+            i.get('package') or i['subject']: {
+                'bundle': i.get('bundle'), 'seconds': i['seconds'],
+                'phases': i['phases'], 'patches': {j: k['seconds'] for j, k in i['patches'].items()}
+            } for i in stages if i['stage'] == 'Patch' and 'phases' in i}
+
+    def PrintComparison(self, path, count = 10):
+        '''Prints the phases and patches of each app which got slower than in an earlier report'''
+        try:
+            with open(path) as file:
+                before = json.load(file).get('patchTimes', {})
+        except (OSError, ValueError) as e:
+            print('### Cannot compare with the report {}: {}'.format(path, e))
+            return
+        for app, now in sorted(self.PatchTimes().items()):
+            old = before.get(app)
+            if not old:
+                continue
+            print('### {} ({} -> {}): {:.2f}s -> {:.2f}s'.format(
+                app, old['bundle'], now['bundle'], old['seconds'], now['seconds']))
+            changes = [('phase ' + i, old['phases'].get(i, 0.0), j) for i, j in now['phases'].items()]
+            changes += [(i, old['patches'].get(i, 0.0), j) for i, j in now['patches'].items()]
+            changes = sorted((i for i in changes if i[2] - i[1] >= 0.01), key=lambda i: i[1] - i[2])[:count]
+            for name, oldSeconds, newSeconds in changes:
+                print('###   {:<50} {:>8.2f}s -> {:>8.2f}s  +{:.2f}s'.format(
+                    name, oldSeconds, newSeconds, newSeconds - oldSeconds))
+
+    def Write(self, path):
+        '''Writes the run report as JSON'''
+        with self.lock:
+            stages = list(self.stages)
+        report = {
+            'started': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            'wallSeconds': round(time.time() - self.started, 3),
+            'summary': self.Summary(),
+            'patchTimes': self.PatchTimes(),
+            'stages': stages
+        }
+        if self.counters:
+            report['counters'] = self.counters
+        # Written atomically, since a watching run rewrites it while it is being read
+        writeJsonAtomic(path, report, indent=1)
+
+class JobCancelled(Exception):
+    '''Raised when a process would be started for a cancelled job'''
+
+class Job:
+    '''A library call running on a thread. Collects the call's stage records, and tracks its processes,
+    which are killed when it is cancelled.'''
+    local = threading.local()
+
+    def __init__(self):
+        self.stages = []
+        self.processes = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Current():
+        '''Returns the job of the current thread, or None'''
+        return getattr(Job.local, 'job', None)
+
+    @staticmethod
+    def Check():
+        '''Raises JobCancelled if the job of the current thread is cancelled'''
+        job = Job.Current()
+        if job and job.cancelled:
+            raise JobCancelled()
+
+    def Run(self, function, *args):
+        '''Calls the function as the job of the current thread'''
+        Job.local.job = self
+        try:
+            return function(*args)
+        finally:
+            Job.local.job = None
+
+    def Attach(self, process):
+        '''Tracks a process of the job, killing it if the job is already cancelled'''
+        with self.lock:
+            self.processes.add(process)
+            if not self.cancelled:
+                return
+        process.kill()
+
+    def Detach(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def Cancel(self):
+        '''Kills the job's processes, and prevents it from starting more'''
+        with self.lock:
+            self.cancelled = True
+            processes = list(self.processes)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+def runProcess(cmd, stage = None, check = False, onLine = None, **kwargs):
+    '''Runs a process like subprocess.run, adding its CPU time and peak RSS to the stage record.
+    At most one of stdout and stderr may be a pipe. With onLine, the piped stdout is passed to it line by line.
+    The process is killed when the job of the current thread is cancelled.'''
+    Job.Check()
+    job = Job.Current()
+    process = subprocess.Popen(cmd, **kwargs)
+    if job:
+        job.Attach(process)
+    if onLine and process.stdout:
+        for line in process.stdout:
+            onLine(line.decode('utf-8', 'replace'))
+        stdout = None
+    else:
+        stdout = process.stdout.read() if process.stdout else None
+    stderr = process.stderr.read() if process.stderr else None
+    usage = None
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    else:
+        process.wait()
+    for stream in (process.stdout, process.stderr):
+        if stream:
+            stream.close()
+    if job:
+        job.Detach(process)
+    if stage is not None:
+        stage['processes'] += 1
+        if usage:
+            # ru_maxrss is in bytes on macOS, in KiB elsewhere
+            peakRss = usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+            stage['cpuSeconds'] = round(stage['cpuSeconds'] + usage.ru_utime + usage.ru_stime, 3)
+            stage['peakRssMiB'] = round(max(stage['peakRssMiB'] or 0, peakRss), 1)
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+class EnvironmentCache:
+    '''Remembers the results of environment probes, each invalidated by a stamp of its inputs'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Stamp(path):
+        '''Returns the modification time and inode of a path, which change when it is replaced'''
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_ino]
+
+    def Get(self, key, stamp):
+        '''Returns the cached value of a probe, or None if its stamp has changed'''
+        entry = self.__read().get(key)
+        if entry and entry['stamp'] == stamp:
+            return entry['value']
+        return None
+
+    def Set(self, key, stamp, value):
+        with self.lock:
+            entries = self.__read()
+            entries[key] = {'stamp': stamp, 'value': value}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            writeJsonAtomic(self.path, entries)
+
+    def __read(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+def fileHashRecords():
+    '''Returns the memoized hashes of existing files, to persist them for seedFileHashes'''
+    records = {}
+    with _hashLock:
+        memo = list(_hashMemo.items())
+    for (path, size, mtime), digest in memo:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+            records[path] = [size, mtime, digest]
+    return records
+
+def seedFileHashes(records):
+    '''Memoizes persisted file hashes, so unchanged files are not read again'''
+    with _hashLock:
+        for path, (size, mtime, digest) in records.items():
+            _memoizeHash((path, size, mtime), digest)
+
+def writeJsonAtomic(path, data, indent = None, replace = True):
+    '''Writes JSON to a temporary file next to the path, then moves it in place, so readers never see a partial file.
+    Without replace, an existing file is kept and False is returned.'''
+    fd, tempPath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.' + os.path.basename(path) + '-')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(data, file, indent=indent)
+        if replace:
+            os.replace(tempPath, path)
+            return True
+        try:
+            # Linking fails if the file exists
+            os.link(tempPath, path)
+            return True
+        except FileExistsError:
+            return False
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+class LruStore:
+    '''A directory of cache entries, evicted in least recently used order above a size budget'''
+    lockTimeout = 6 * 3600 # Locks older than this are considered abandoned
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+
+    def Path(self, key):
+        return os.path.join(self.directory, key)
+
+    def Lock(self, key):
+        '''Reserves an entry for exclusive use, returns False if it is already in use'''
+        lockPath = self.Path(key) + '.lock'
+        for _ in range(2):
+            try:
+                os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lockPath) < self.lockTimeout:
+                        return False
+                    os.remove(lockPath)
+                except FileNotFoundError:
+                    pass
+        return False
+
+    def Unlock(self, key):
+        try:
+            os.remove(self.Path(key) + '.lock')
+        except FileNotFoundError:
+            pass
+
+    def Touch(self, key):
+        '''Marks an entry as recently used'''
+        os.utime(self.Path(key))
+
+    def Remove(self, key):
+        path = self.Path(key)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def Entries(self):
+        '''Returns (key, size, last use) tuples of the stored entries, most recently used first'''
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.Path(key)
+            if key.endswith('.lock') or key.startswith('.'):
+                continue
+            if os.path.isdir(path):
+                size = sum(
+                    os.path.getsize(os.path.join(root, name))
+                    for root, _, names in os.walk(path) for name in names)
+            else:
+                size = os.path.getsize(path)
+            entries.append((key, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda i: i[2], reverse=True)
+
+    def Evict(self, keep = ()):
+        '''Removes the least recently used, unlocked entries until the store fits its budget'''
+        total = 0
+        for key, size, _ in self.Entries():
+            total += size
+            if total > self.budget and key not in keep and self.Lock(key):
+                self.Remove(key)
+                self.Unlock(key)
+                total -= size
+
+class ApkCache:
+    '''Keeps downloaded APKs by package, version, arch and dpi, verified by their SHA-256 hash.
+    Each entry is a directory holding the APK under its downloaded name.'''
+
+    def __init__(self, directory, budget):
+        self.store = LruStore(directory, budget)
+        self.indexPath = os.path.join(directory, '.index.json')
+        self.inUse = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Key(package, version, arch, dpi):
+        return re.sub(r'[^\w.-]', '_', '_'.join((package, version, arch, dpi)))
+
+    def Get(self, key):
+        '''Returns the path of a cached APK and marks it in use, or None if it is not cached'''
+        with self.lock:
+            entry = self.__readIndex().get(key)
+            if not entry:
+                return None
+            path = os.path.join(self.store.Path(key), entry['name'])
+            digest = entry['sha256']
+            if fileHash(path) != digest:
+                printLocked('### The cached {} is corrupt, discarding it.'.format(key))
+                self.store.Remove(key)
+                return None
+            self.store.Touch(key)
+            self.inUse[key] = self.inUse.get(key, 0) + 1
+        return path
+
+    def Add(self, key, srcPath):
+        '''Moves a downloaded APK into the cache, returns its new path marked in use'''
+        path = os.path.join(self.store.Path(key), os.path.basename(srcPath))
+        with self.lock:
+            self.store.Remove(key)
+            os.makedirs(self.store.Path(key))
+            shutil.move(srcPath, path)
+            index = self.__readIndex()
+            index[key] = {'name': os.path.basename(path), 'sha256': fileHash(path)}
+            self.__writeIndex(index)
+            self.inUse[key] = self.inUse.get(key, 0) + 1
+            self.store.Evict(keep=set(self.inUse))
+        return path
+
+    def Owns(self, path):
+        entryDir = os.path.dirname(os.path.abspath(path))
+        return os.path.dirname(entryDir) == os.path.abspath(self.store.directory)
+
+    def Release(self, path):
+        '''Marks a cached APK returned by Get or Add as no longer in use'''
+        key = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        with self.lock:
+            self.inUse[key] -= 1
+            if not self.inUse[key]:
+                del self.inUse[key]
+
+    def PrintStats(self):
+        entries = self.store.Entries()
+        print('### APK cache {}: {} APKs, {:.1f} of {:.1f} MiB used'.format(
+            self.store.directory, len(entries),
+            sum(i[1] for i in entries) / 2**20, self.store.budget / 2**20))
+        for key, size, lastUse in entries:
+            print('###   {:<60} {:>8.1f} MiB  last used {}'.format(
+                key, size / 2**20, time.strftime('%Y-%m-%d %H:%M', time.localtime(lastUse))))
+
+    def __readIndex(self):
+        try:
+            with open(self.indexPath) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(os.path.join(self.store.Path(key), entry['name']))}
+
+    def __writeIndex(self, index):
+        writeJsonAtomic(self.indexPath, index)
+
+def availableMemory():
+    '''Returns the memory available for new processes in MiB, or None if it cannot be determined'''
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) >> 10
+    except OSError:
+        pass
+    try:
+        return (os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')) >> 20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+class MemoryScheduler:
+    '''Admits patch jobs while their estimated memory fits into the available memory'''
+    # Each job reserves its estimated peak RSS with some headroom until it finishes. When jobs run
+    # concurrently, their JVM heaps are limited to the reservation, otherwise the JVM default applies.
+    headroom = 1.5
+
+    def __init__(self, estimatesPath, defaultEstimate, reserve):
+        self.estimatesPath = estimatesPath
+        self.defaultEstimate = defaultEstimate
+        self.reserve = reserve
+        self.capacity = None
+        self.reserved = 0
+        self.running = 0
+        self.waiting = []
+        self.condition = threading.Condition()
+        try:
+            with open(estimatesPath) as file:
+                self.estimates = json.load(file)
+        except (OSError, ValueError):
+            self.estimates = {}
+
+    def Budget(self, key):
+        '''Returns the heap limit in MiB for a job, from the peak RSS observed in its previous runs'''
+        with self.condition:
+            return int(self.estimates.get(key, self.defaultEstimate) * MemoryScheduler.headroom)
+
+    @contextlib.contextmanager
+    def Admit(self, key, stage = None):
+        '''Waits until the job's memory budget is available, yields the budget in MiB'''
+        budget = self.Budget(key)
+        ticket = object()
+        startTime = time.perf_counter()
+        with self.condition:
+            self.waiting.append(ticket)
+            while not self.__fits(ticket, budget):
+                if ticket is self.waiting[0] and startTime is not None:
+                    printLocked('### Waiting for {} MiB of memory for {} ({} of {} MiB reserved).'.format(
+                        budget, key, self.reserved, self.capacity))
+                    startTime = None
+                self.condition.wait()
+            self.waiting.remove(ticket)
+            self.reserved += budget
+            self.running += 1
+            self.condition.notify_all()
+        if stage is not None:
+            stage['heapMiB'] = budget
+        try:
+            yield budget
+        finally:
+            with self.condition:
+                self.reserved -= budget
+                self.running -= 1
+                self.condition.notify_all()
+
+    def __fits(self, ticket, budget):
+        # The jobs are admitted in order, so large jobs do not starve behind small ones
+        if ticket is not self.waiting[0]:
+            return False
+        if not self.running:
+            # The capacity is measured when no job is running, the first job is always admitted
+            available = availableMemory()
+            self.capacity = None if available is None else max(available - self.reserve, 0)
+            return True
+        return self.capacity is None or self.reserved + budget <= self.capacity
+
+    def Record(self, key, stage, heapMiB, success):
+        '''Updates the estimate of the job from its observed peak RSS'''
+        peakRss = stage.get('peakRssMiB')
+        if not peakRss or stage.get('jvmWorker'):
+            return
+        if success:
+            estimate = peakRss
+        elif heapMiB and peakRss >= heapMiB * 0.9:
+            estimate = peakRss * MemoryScheduler.headroom # The job may have run out of heap
+        else:
+            return
+        with self.condition:
+            self.estimates[key] = round(estimate)
+            writeJsonAtomic(self.estimatesPath, self.estimates, indent=1)
+
+class ToolStore:
+    '''Keeps downloaded tool assets named by their SHA-256 hash, so several versions coexist and
+    identical assets are stored once. The index maps each project and tag to its stored assets.'''
+
+    def __init__(self, directory, budget):
+        self.store = LruStore(directory, budget)
+        self.indexPath = os.path.join(directory, '.index.json')
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Key(project, tag):
+        return '{}@{}'.format(project, tag.lstrip('v'))
+
+    def GetRelease(self, project, tag):
+        '''Returns the stored assets of a release in the format of the GitHub API, or None'''
+        with self.lock:
+            return self.__readIndex().get(ToolStore.Key(project, tag))
+
+    def Find(self, project, tag, name):
+        '''Returns the hash of a stored asset, or None'''
+        release = self.GetRelease(project, tag)
+        asset = next((i for i in release['assets'] if i['name'] == name), None) if release else None
+        return asset['sha256'] if asset else None
+
+    def Lookup(self, project, tag, asset):
+        '''Returns the hash of a release asset if it is known from the store or its digest, or None'''
+        sha256 = asset.get('sha256') or self.Find(project, tag, asset['name'])
+        if not sha256 and (asset.get('digest') or '').startswith('sha256:'):
+            sha256 = asset['digest'][len('sha256:'):] # Identical assets of other releases are reused
+        return sha256
+
+    def Has(self, sha256):
+        return os.path.isfile(self.store.Path(sha256))
+
+    def Add(self, project, tag, asset, srcPath):
+        '''Moves a downloaded asset into the store, returns its hash'''
+        sha256 = fileHash(srcPath)
+        with self.lock:
+            if self.Has(sha256):
+                os.remove(srcPath)
+            else:
+                os.replace(srcPath, self.store.Path(sha256))
+        self.Index(project, tag, asset, sha256)
+        return sha256
+
+    def Index(self, project, tag, asset, sha256):
+        '''Records a stored asset as part of a release'''
+        with self.lock:
+            index = self.__readIndex()
+            release = index.setdefault(ToolStore.Key(project, tag), {'tag_name': tag, 'assets': []})
+            release['assets'] = [i for i in release['assets'] if i['name'] != asset['name']] + [{
+                'name': asset['name'], 'content_type': asset['content_type'],
+                'size': os.path.getsize(self.store.Path(sha256)), 'sha256': sha256}]
+            self.__writeIndex(index)
+
+    def Link(self, sha256, path, executable = False):
+        '''Hard links a stored asset to the path, or copies it where links are not supported'''
+        blobPath = self.store.Path(sha256)
+        tempPath = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.link')
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        try:
+            os.link(blobPath, tempPath)
+        except OSError:
+            shutil.copyfile(blobPath, tempPath)
+        if executable:
+            os.chmod(tempPath, os.stat(tempPath).st_mode | 0o111)
+        os.replace(tempPath, path)
+        self.store.Touch(sha256)
+
+    def Collect(self):
+        '''Removes the least recently used assets which are not linked to a tools directory,
+        until the store fits its budget. Returns the number of removed assets and bytes.'''
+        with self.lock:
+            before = self.store.Entries()
+            # An asset with more than one link is the selected version in a tools directory
+            self.store.Evict(keep={i[0] for i in before if os.stat(self.store.Path(i[0])).st_nlink > 1})
+            after = {i[0] for i in self.store.Entries()}
+        removed = [i for i in before if i[0] not in after]
+        return len(removed), sum(i[1] for i in removed)
+
+    def PrintStats(self):
+        entries = self.store.Entries()
+        print('### Tool store {}: {} assets, {:.1f} of {:.1f} MiB used'.format(
+            self.store.directory, len(entries), sum(i[1] for i in entries) / 2**20, self.store.budget / 2**20))
+
+    def __readIndex(self):
+        try:
+            with open(self.indexPath) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        for release in index.values():
+            release['assets'] = [i for i in release['assets'] if self.Has(i['sha256'])]
+        return {key: release for key, release in index.items() if release['assets']}
+
+    def __writeIndex(self, index):
+        writeJsonAtomic(self.indexPath, index)
+
+class ScratchSpace:
+    '''Places the temporary files of each job in the first scratch directory with enough free space,
+    counting the space reserved by the running jobs on the same file system'''
+    downloadSize = 256 << 20 # The space reserved for each downloaded APK, whose size is not known in advance
+
+    def __init__(self, directories, multiplier):
+        self.directories = list(dict.fromkeys(list(directories) + [tempfile.gettempdir()]))
+        self.multiplier = multiplier
+        self.reserved = {}
+        self.placements = {}
+        self.lock = threading.Lock()
+
+    def Acquire(self, needed, prefix, subject, stage = None):
+        '''Creates a temporary directory for a job needing the given bytes, returns its path'''
+        with self.lock:
+            candidates = []
+            for directory in self.directories:
+                try:
+                    os.makedirs(directory, exist_ok=True)
+                    device = os.stat(directory).st_dev
+                    free = shutil.disk_usage(directory).free - self.reserved.get(device, 0)
+                except OSError:
+                    continue
+                candidates.append((directory, device, free))
+            # Without enough space anywhere, the location with the most free space is tried
+            fitting = [i for i in candidates if i[2] >= needed]
+            for directory, device, free in fitting or sorted(candidates, key=lambda i: -i[2]):
+                try:
+                    path = tempfile.mkdtemp(dir=directory, prefix=prefix)
+                except OSError:
+                    continue
+                self.reserved[device] = self.reserved.get(device, 0) + needed
+                self.placements[path] = (device, needed)
+                break
+            else:
+                raise RuntimeError('No scratch directory is usable.')
+        if not fitting:
+            printLocked('### Warning: No scratch directory has {:.0f} MiB free for {}, using {}.'.format(
+                needed / 2**20, subject, directory))
+        elif len(self.directories) > 1:
+            printLocked('### Temporary files of {} in {} ({:.0f} MiB needed, {:.0f} MiB free).'.format(
+                subject, directory, needed / 2**20, free / 2**20))
+        if stage is not None:
+            stage['scratch'] = directory
+        return path
+
+    def Release(self, path, remove = True):
+        '''Frees the space reserved for a temporary directory, and removes it unless remove is False'''
+        with self.lock:
+            device, needed = self.placements.pop(path)
+            self.reserved[device] -= needed
+        if remove:
+            shutil.rmtree(path, ignore_errors=True)
+
+class HttpPool:
+    '''Sends HTTP requests over kept-alive connections, reusing them per host'''
+    maxRedirects = 5
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.sslContext = ssl.create_default_context()
+
+    @contextlib.contextmanager
+    def Open(self, url, headers = {}):
+        '''Sends a GET request, following redirects. Yields the response, like urllib.request.urlopen.
+        Raises urllib.error.HTTPError for error statuses.'''
+        scheme = urllib.parse.urlsplit(url).scheme
+        if scheme not in ('http', 'https') or scheme in urllib.request.getproxies():
+            # Proxies and local files are only supported by urllib
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                yield response
+            return
+        for _ in range(HttpPool.maxRedirects + 1):
+            connection, key, response = self.__send(url, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                self.__release(key, connection, response)
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400 or response.status == 304:
+                body = response.read()
+                self.__release(key, connection, response)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+            try:
+                yield response
+            except BaseException:
+                connection.close()
+                raise
+            self.__release(key, connection, response)
+            return
+        raise urllib.error.URLError('Too many redirects: ' + url)
+
+    def __send(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for reused in (True, False):
+            connection = None
+            if reused:
+                with self.lock:
+                    if self.idle.get(key):
+                        connection = self.idle[key].pop()
+                if not connection:
+                    continue
+            elif parts.scheme == 'https':
+                connection = http.client.HTTPSConnection(parts.netloc, timeout=60, context=self.sslContext)
+            else:
+                connection = http.client.HTTPConnection(parts.netloc, timeout=60)
+            try:
+                connection.request('GET', path, headers=dict(headers, **{'User-Agent': 'revanced-auto-patcher'}))
+                return connection, key, connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                # The kept-alive connection was closed by the server, retry on a new one
+
+    def __release(self, key, connection, response):
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                self.idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+
+class GithubClient:
+    '''Looks up GitHub releases, caching their metadata and revalidating it with conditional requests.
+    Authenticates with the GITHUB_TOKEN or GH_TOKEN environment variable, and waits for the rate limit to reset
+    when it is exhausted.'''
+    maxAttempts = 5
+    defaultBackoff = 60 # Seconds to wait after a rate limit response without a reset time
+
+    def __init__(self, apiUrl, cachePath, ttl, refresh = False, offline = False, maxWait = settings['githubMaxWait']):
+        self.apiUrl = apiUrl.rstrip('/')
+        self.cachePath = cachePath
+        self.ttl = ttl
+        self.refresh = refresh
+        self.offline = offline
+        self.maxWait = maxWait
+        self.token = os.environ.get('GITHUB_TOKEN') or os.environ.get('GH_TOKEN')
+        self.revalidated = set()
+        self.inflight = {}
+        self.budget = {}
+        self.blockedUntil = 0.0
+        self.requests = 0
+        self.coalesced = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+        self.http = HttpPool()
+        try:
+            with open(cachePath) as file:
+                self.cache = json.load(file)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def GetRelease(self, project, version = 'latest'):
+        '''Returns the release data of a project's given version. Concurrent lookups of a release share one request.'''
+        if version != 'latest':
+            version = 'tags/v' + version.lstrip('v')
+        url = '{0}/repos/{1}/releases/{2}'.format(self.apiUrl, project, version)
+        with self.lock:
+            entry = self.cache.get(url)
+            forced = self.refresh and url not in self.revalidated
+            if entry and not forced and time.time() - entry['fetched'] < self.ttl:
+                return entry['data']
+            pending = self.inflight.get(url)
+            owner = pending is None
+            if owner:
+                pending = self.inflight[url] = concurrent.futures.Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return pending.result()
+        try:
+            data = self.__lookup(url, project, version, entry)
+            pending.set_result(data)
+            return data
+        except BaseException as e:
+            pending.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[url]
+
+    def Budget(self):
+        '''Returns the request counts of the run and the last known rate limit budget'''
+        with self.lock:
+            return dict(
+                self.budget, requests=self.requests, coalesced=self.coalesced,
+                waitedSeconds=round(self.waited, 3), authenticated=bool(self.token))
+
+    def PrintBudget(self):
+        budget = self.Budget()
+        if not budget['requests']:
+            return
+        remaining = ''
+        if 'remaining' in budget:
+            remaining = ', {} of {} remaining until {}'.format(
+                budget['remaining'], budget['limit'],
+                datetime.datetime.fromtimestamp(budget['reset']).strftime('%H:%M:%S'))
+        printLocked('### GitHub API: {} requests ({}){}{}{}.'.format(
+            budget['requests'], 'authenticated' if budget['authenticated'] else 'unauthenticated', remaining,
+            ', {} shared'.format(budget['coalesced']) if budget['coalesced'] else '',
+            ', waited {:.0f}s for the rate limit'.format(budget['waitedSeconds']) if budget['waitedSeconds'] else ''))
+
+    def __lookup(self, url, project, version, entry):
+        if self.offline:
+            if entry:
+                return entry['data']
+            raise RuntimeError('The {} release of {} was never looked up, so it is unknown offline.'.format(version, project))
+
+        headers = {'Accept': 'application/vnd.github+json'}
+        if self.token:
+            headers['Authorization'] = 'Bearer ' + self.token
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+        for attempt in range(GithubClient.maxAttempts):
+            wait = self.blockedUntil - time.time()
+            if wait > 0:
+                if entry:
+                    printLocked('### The GitHub rate limit is exhausted, using the cached {} release of {}.'.format(version, project))
+                    return entry['data']
+                if wait > self.maxWait:
+                    raise RuntimeError('The GitHub rate limit is exhausted for {:.0f} minutes.{}'.format(
+                        wait / 60, '' if self.token else ' Set GITHUB_TOKEN for a higher limit.'))
+                printLocked('### Waiting {:.0f}s for the GitHub rate limit to reset...'.format(wait))
+                time.sleep(wait)
+                with self.lock:
+                    self.waited += wait
+            with self.lock:
+                self.requests += 1
+            try:
+                with self.http.Open(url, headers) as response:
+                    self.__track(response.headers)
+                    entry = {
+                        'etag': response.headers.get('ETag'),
+                        'lastModified': response.headers.get('Last-Modified'),
+                        'data': json.loads(response.read())
+                    }
+                break
+            except urllib.error.HTTPError as e:
+                self.__track(e.headers)
+                if self.__rateLimited(e, attempt):
+                    continue
+                if not entry or e.code != 304 and e.code < 500:
+                    raise
+                if e.code != 304:
+                    printLocked('### GitHub failed ({}), using the cached {} release of {}.'.format(e, version, project))
+                    return entry['data']
+                break
+            except OSError as e:
+                if not entry:
+                    raise
+                printLocked('### GitHub is unreachable ({}), using the cached {} release of {}.'.format(e, version, project))
+                return entry['data']
+        else:
+            raise RuntimeError('GitHub kept rate limiting the lookup of the {} release of {}.'.format(version, project))
+        entry['fetched'] = time.time()
+        with self.lock:
+            self.cache[url] = entry
+            self.revalidated.add(url)
+            self.__save()
+        return entry['data']
+
+    def __track(self, headers):
+        '''Records the rate limit budget from the response headers'''
+        if not headers or headers.get('X-RateLimit-Remaining') is None:
+            return
+        try:
+            budget = {i: int(headers.get('X-RateLimit-' + i.capitalize(), 0)) for i in ('limit', 'remaining', 'reset', 'used')}
+        except ValueError:
+            return
+        with self.lock:
+            self.budget = budget
+            if budget['remaining'] == 0:
+                self.blockedUntil = max(self.blockedUntil, budget['reset'] + 1)
+
+    def __rateLimited(self, error, attempt):
+        '''Returns whether the error is a rate limit response, and blocks the requests until it can be retried'''
+        retryAfter = error.headers.get('Retry-After') if error.headers else None
+        exhausted = error.headers is not None and error.headers.get('X-RateLimit-Remaining') == '0'
+        if error.code not in (403, 429) or not (retryAfter or exhausted or error.code == 429):
+            return False
+        with self.lock:
+            if retryAfter and retryAfter.isdigit():
+                self.blockedUntil = max(self.blockedUntil, time.time() + int(retryAfter))
+            elif not exhausted:
+                # Secondary rate limits without a reset time are retried with an exponential backoff
+                self.blockedUntil = max(self.blockedUntil, time.time() + GithubClient.defaultBackoff * 2 ** attempt)
+        return True
+
+    def __save(self):
+        os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+        writeJsonAtomic(self.cachePath, self.cache)
+
+class ReleaseMirror:
+    '''A local directory of tool releases, which replaces the GitHub API to provision the tools without network.
+    It has the format of the tool store, with the latest tag of each project in .latest.json.'''
+    offline = False # The assets are copied from the mirror directory
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.store = ToolStore(directory, 0)
+        self.latestPath = os.path.join(directory, '.latest.json')
+        self.http = HttpPool()
+        self.lock = threading.Lock()
+
+    def GetRelease(self, project, version = 'latest'):
+        '''Returns the release data of a project's given version, with file URLs of the assets'''
+        tag = self.__readLatest().get(project) if version == 'latest' else version
+        release = self.store.GetRelease(project, tag) if tag else None
+        if not release:
+            raise RuntimeError('The {} release of {} is not in the mirror {}.'.format(version, project, self.directory))
+        return {'tag_name': release['tag_name'], 'assets': [
+            dict(i, browser_download_url=pathlib.Path(os.path.abspath(self.store.store.Path(i['sha256']))).as_uri())
+            for i in release['assets']]}
+
+    def Sync(self, github, project, version, content_type_filter = None, name_filter = None, executable = False):
+        '''Copies the suitable assets of a release from GitHub into the mirror, returns the number of downloaded bytes'''
+        release = github.GetRelease(project, version)
+        tag = release['tag_name']
+        assets = selectAssets(release, content_type_filter, name_filter)
+        if not assets:
+            raise RuntimeError('No suitable asset found for tool {}.'.format(project))
+        downloaded = 0
+        for asset in assets:
+            sha256 = self.store.Lookup(project, tag, asset)
+            if sha256 and self.store.Has(sha256):
+                self.store.Index(project, tag, asset, sha256)
+                continue
+            printLocked('### Mirroring {} {}...'.format(asset['name'], tag))
+            path = self.store.store.Path('.' + asset['name'])
+            downloaded += downloadFile(
+                asset['browser_download_url'], path, size=asset.get('size'), digest=asset.get('digest'),
+                executable=executable, pool=github.http)[0]
+            self.store.Add(project, tag, asset, path)
+        if version == 'latest':
+            with self.lock:
+                latest = self.__readLatest()
+                latest[project] = tag
+                writeJsonAtomic(self.latestPath, latest, indent=1)
+        return downloaded
+
+    def __readLatest(self):
+        try:
+            with open(self.latestPath) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+def selectAssets(releaseData, content_type_filter = None, name_filter = None):
+    '''Returns the assets of a release which match the content type and name regular expressions'''
+    return [i for i in releaseData['assets']
+        if (not content_type_filter or
+            re.match('^{}$'.format(content_type_filter), i['content_type'])) and
+           (not name_filter or re.match('^{}$'.format(name_filter), i['name']))]
+
+def downloadFile(url, path, size = None, digest = None, executable = False, attempts = 3, pool = None):
+    '''Downloads a file to a temporary file next to the path, resuming interrupted transfers.
+    The file is verified against the expected size and "sha256:..." digest, and renamed into place.
+    Returns the number of downloaded and resumed bytes, and the seconds taken.'''
+    directory, name = os.path.split(path)
+    partPath = os.path.join(directory, '.' + name + '.part') # Hidden from the tool globs
+    startTime = time.time()
+    downloaded = resumed = 0
+    for attempt in range(attempts):
+        offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+        if size is not None and offset > size:
+            os.remove(partPath)
+            offset = 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            with (pool or HttpPool()).Open(url, headers) as response:
+                if offset and response.status != 206:
+                    offset = 0 # The server ignored the range, start over
+                length = response.headers.get('Content-Length')
+                expected = size if size is not None else offset + int(length) if length and length.isdigit() else None
+                resumed += offset
+                with open(partPath, 'ab' if offset else 'wb') as file:
+                    for chunk in iter(lambda: response.read(1 << 20), b''):
+                        file.write(chunk)
+                        downloaded += len(chunk)
+            # A connection closed early ends the response without an error
+            received = os.path.getsize(partPath)
+            if expected is not None and received < expected:
+                raise http.client.IncompleteRead(b'', expected - received)
+            break
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or size is None or offset != size:
+                raise
+            break # The partial file is already complete
+        except (OSError, http.client.HTTPException) as e:
+            if attempt + 1 == attempts:
+                # The partial file is kept, to be resumed by the next run
+                raise RuntimeError('The download of {} was interrupted: {!r}'.format(name, e)) from e
+            printLocked('### Download of {} interrupted, resuming...'.format(name))
+
+    actualSize = os.path.getsize(partPath)
+    if size is not None and actualSize != size:
+        if actualSize > size:
+            os.remove(partPath)
+        raise RuntimeError('Downloaded {} has {} bytes instead of {}.'.format(name, actualSize, size))
+    if digest and digest.startswith('sha256:'):
+        actualDigest = fileHash(partPath)
+        if actualDigest != digest[len('sha256:'):]:
+            os.remove(partPath)
+            raise RuntimeError('Downloaded {} has a SHA-256 digest mismatch.'.format(name))
+    if executable:
+        os.chmod(partPath, os.stat(partPath).st_mode | 0o111)
+    os.replace(partPath, path)
+    return downloaded, resumed, time.time() - startTime
+
+class JvmWorker:
+    '''A resident JVM that keeps the CLI loaded and runs several CLI commands, one at a time'''
+    # The worker calls the CLI's entry point for each command line it reads from stdin.
+    # The CLI's System.exit calls are trapped, and its console output is redirected per command.
+    source = r'''
+import java.io.*;
+import java.lang.reflect.*;
+import java.net.*;
+import java.util.*;
+import java.util.jar.*;
+
+public class PatchWorker {
+    static class ExitTrap extends SecurityException {
+        final int status;
+        ExitTrap(int status) { super("exit " + status); this.status = status; }
+    }
+
+    static class Redirect extends OutputStream {
+        volatile OutputStream target;
+        Redirect(OutputStream target) { this.target = target; }
+        public void write(int b) throws IOException { target.write(b); }
+        public void write(byte[] b, int off, int len) throws IOException { target.write(b, off, len); }
+        public void flush() throws IOException { target.flush(); }
+    }
+
+    public static void main(String[] args) throws Exception {
+        PrintStream protocol = System.out;
+        PrintStream console = System.err;
+        Redirect redirect = new Redirect(console);
+        PrintStream redirected = new PrintStream(redirect, true, "UTF-8");
+        System.setOut(redirected);
+        System.setErr(redirected);
+
+        File cli = new File(args[0]);
+        String mainClass;
+        try (JarFile jar = new JarFile(cli)) {
+            mainClass = jar.getManifest().getMainAttributes().getValue("Main-Class");
+        }
+        ClassLoader loader = new URLClassLoader(new URL[] { cli.toURI().toURL() }, PatchWorker.class.getClassLoader());
+        Thread.currentThread().setContextClassLoader(loader);
+        Method entry = Class.forName(mainClass, true, loader).getMethod("main", String[].class);
+        System.setSecurityManager(new SecurityManager() {
+            @Override public void checkExit(int status) { throw new ExitTrap(status); }
+            @Override public void checkPermission(java.security.Permission perm) { }
+            @Override public void checkPermission(java.security.Permission perm, Object context) { }
+        });
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        protocol.println("READY");
+        protocol.flush();
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] parts = line.split("\t", -1);
+            OutputStream out = parts[0].isEmpty() ? console : new FileOutputStream(parts[0]);
+            redirect.target = out;
+            int status = 0;
+            try {
+                entry.invoke(null, (Object) Arrays.copyOfRange(parts, 1, parts.length));
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                while (cause != null && !(cause instanceof ExitTrap)) {
+                    cause = cause.getCause();
+                }
+                if (cause != null) {
+                    status = ((ExitTrap) cause).status;
+                } else {
+                    e.getCause().printStackTrace(redirected);
+                    status = 1;
+                }
+            } finally {
+                redirected.flush();
+                redirect.target = console;
+                if (out != console) {
+                    out.close();
+                }
+            }
+            // The console lines arrive on another stream than the reply, the marker ends those of the command
+            console.println("PatchWorker: END");
+            console.flush();
+            protocol.println("DONE " + status);
+            protocol.flush();
+        }
+    }
+}
+'''
+
+    consoleEnd = 'PatchWorker: END' # The console line written after the output of each command
+
+    def __init__(self, cliPath, workDir):
+        sourcePath = os.path.join(workDir, 'PatchWorker.java')
+        try:
+            with open(sourcePath) as file:
+                upToDate = file.read() == JvmWorker.source
+        except OSError:
+            upToDate = False
+        if not upToDate:
+            # Replaced atomically, since another worker may be compiling it
+            fd, tempPath = tempfile.mkstemp(dir=workDir, prefix='.PatchWorker-')
+            with os.fdopen(fd, 'w') as file:
+                file.write(JvmWorker.source)
+            os.replace(tempPath, sourcePath)
+        self.lock = threading.Lock()
+        self.process = None
+        self.onLine = None
+        self.consoleDone = threading.Event()
+        # Java 18+ needs the security manager to be allowed explicitly, Java 11 does not know the flag
+        for flags in (['-Djava.security.manager=allow'], []):
+            process = subprocess.Popen(
+                ['java'] + flags + [sourcePath, cliPath],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                encoding='utf-8')
+            self.started = threading.Event()
+            threading.Thread(target=self.__forwardConsole, args=(process,), daemon=True).start()
+            if process.stdout.readline().strip() == 'READY':
+                self.process = process
+                self.started.set()
+                return
+            process.kill()
+            process.wait()
+        raise RuntimeError('The JVM worker could not be started.')
+
+    def __forwardConsole(self, process):
+        '''Shows the worker's console output, except startup errors of attempts that fail'''
+        for line in process.stderr:
+            if self.started.is_set() and process is self.process:
+                if line.rstrip('\n') == JvmWorker.consoleEnd:
+                    self.consoleDone.set()
+                    continue
+                onLine = self.onLine
+                if onLine:
+                    onLine(line)
+                else:
+                    sys.stderr.write(line)
+                    sys.stderr.flush()
+        if process is self.process:
+            self.consoleDone.set() # The worker terminated
+
+    def Run(self, cliArgs, outPath = None, onLine = None):
+        '''Runs a CLI command, writing its output to outPath, or passing its console lines to onLine
+        or the console. Returns the exit code.'''
+        job = Job.Current()
+        with self.lock:
+            # Cancelling the job kills the worker, which then falls back to a java process that is not started
+            if job:
+                job.Attach(self.process)
+            self.onLine = onLine
+            self.consoleDone.clear()
+            try:
+                self.process.stdin.write('\t'.join([outPath or ''] + cliArgs) + '\n')
+                self.process.stdin.flush()
+                reply = self.process.stdout.readline()
+                if reply.startswith('DONE '):
+                    # The last console lines of the command may still be on their way
+                    self.consoleDone.wait()
+            finally:
+                self.onLine = None
+                if job:
+                    job.Detach(self.process)
+        if not reply.startswith('DONE '):
+            raise RuntimeError('The JVM worker terminated unexpectedly.')
+        return int(reply.split()[1])
+
+    def Close(self):
+        if self.process and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+class JvmWorkerPool:
+    '''Hands out idle JVM workers, starting new ones for concurrent callers'''
+
+    def __init__(self, cliPath, workDir):
+        self.cliPath = cliPath
+        self.workDir = workDir
+        self.idle = []
+        self.workers = []
+        self.available = True
+        self.lock = threading.Lock()
+        atexit.register(self.Close)
+
+    def Run(self, cliArgs, outPath = None, onLine = None):
+        '''Runs a CLI command in a worker, returns its exit code or None if no worker can be used'''
+        Job.Check()
+        with self.lock:
+            if not self.available:
+                return None
+            worker = self.idle.pop() if self.idle else None
+        if not worker:
+            try:
+                worker = JvmWorker(self.cliPath, self.workDir)
+            except (OSError, RuntimeError):
+                printLocked('### The JVM worker is unavailable, falling back to separate java processes.')
+                with self.lock:
+                    self.available = False
+                return None
+            with self.lock:
+                self.workers.append(worker)
+        try:
+            status = worker.Run(cliArgs, outPath, onLine)
+        except (OSError, RuntimeError):
+            with self.lock:
+                self.workers.remove(worker)
+            return None
+        with self.lock:
+            self.idle.append(worker)
+        return status
+
+    def Close(self):
+        with self.lock:
+            workers, self.workers, self.idle = self.workers, [], []
+        for worker in workers:
+            worker.Close()
+
+class DirectoryWatcher:
+    '''Reports the APKs that are added to or changed in a directory, once they are completely written'''
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+
+    def __init__(self, directory, settle, pollInterval, exclude = ()):
+        self.directory = directory
+        self.settle = settle
+        self.pollInterval = pollInterval
+        self.exclude = tuple(exclude)
+        self.pending = {}
+        self.snapshot = {}
+        self.inotify = DirectoryWatcher.__openInotify(directory)
+        # The APKs which are already there are reported first
+        for path in self.__scan():
+            self.pending[path] = None
+
+    @staticmethod
+    def __openInotify(directory):
+        '''Returns an inotify file descriptor watching the directory, or None to fall back to polling'''
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = DirectoryWatcher.IN_CLOSE_WRITE | DirectoryWatcher.IN_MOVED_TO
+            if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def Mode(self):
+        return 'inotify' if self.inotify is not None else 'polling every {}s'.format(self.pollInterval)
+
+    def Wait(self):
+        '''Blocks until some APKs are completely written, returns their paths'''
+        while True:
+            if self.pending:
+                timeout = self.settle
+            else:
+                timeout = None if self.inotify is not None else self.pollInterval
+            for path in self.__changes(timeout):
+                self.pending[path] = None
+            ready = self.__settled()
+            if ready:
+                return ready
+
+    def __changes(self, timeout):
+        if self.inotify is None:
+            time.sleep(timeout)
+            return self.__scan()
+        if not select.select([self.inotify], [], [], timeout)[0]:
+            return []
+        data = os.read(self.inotify, 65536)
+        changes = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if self.__isInput(name):
+                changes.append(os.path.join(self.directory, name))
+        return changes
+
+    def __scan(self):
+        '''Returns the APKs which are new or changed since the previous scan'''
+        snapshot = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and self.__isInput(entry.name):
+                stat = entry.stat()
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        changes = [i for i, j in snapshot.items() if self.snapshot.get(i) != j]
+        self.snapshot = snapshot
+        return changes
+
+    def __isInput(self, name):
+        return name.lower().endswith('.apk') and not name.startswith('.') and not name.startswith(self.exclude)
+
+    def __settled(self):
+        '''Returns the pending APKs whose size and modification time stayed the same for the settle time'''
+        ready = []
+        now = time.monotonic()
+        for path, seen in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path] # Removed or renamed before it was complete
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if seen and seen[0] == signature and now - seen[1] >= self.settle:
+                del self.pending[path]
+                ready.append(path)
+            elif not seen or seen[0] != signature:
+                self.pending[path] = (signature, now)
+        return ready
+
+    def Close(self):
+        if self.inotify is not None:
+            os.close(self.inotify)
+            self.inotify = None
+
+class JobQueue:
+    '''A queue of patch jobs in a shared directory, which workers on several hosts claim with lease files.
+    A worker renews its lease while it runs the job. Once a lease is older than the lease timeout, the job's next
+    attempt may be claimed by another worker, so the jobs of dead workers are retried.'''
+    maxAttempts = 3
+
+    def __init__(self, directory, leaseTimeout):
+        self.directory = directory
+        self.leaseTimeout = leaseTimeout
+        for subdir in ('jobs', 'leases', 'results', 'inputs', 'outputs'):
+            os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    def AddInput(self, path):
+        '''Copies an APK into the queue, returns its path relative to the queue directory'''
+        relPath = os.path.join('inputs', fileHash(path)[:16], os.path.basename(path))
+        target = os.path.join(self.directory, relPath)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.input-')
+            os.close(fd)
+            shutil.copyfile(path, tempPath)
+            os.replace(tempPath, target)
+        return relPath
+
+    def Publish(self, job):
+        '''Publishes a job: its app and version, or input, and its patchSrc and forwardedArgs. Returns its id.'''
+        # The ids sort in publishing order, so the jobs are claimed first in, first out
+        jobId = '{:013d}-{}'.format(int(time.time() * 1000), os.urandom(4).hex())
+        writeJsonAtomic(os.path.join(self.directory, 'jobs', jobId + '.json'), dict(job, id=jobId))
+        return jobId
+
+    def Claim(self, worker, sources):
+        '''Claims the oldest unfinished job of the given patch sources which is not leased.
+        Returns the job and its attempt number, or None if there is none.'''
+        for name in sorted(os.listdir(os.path.join(self.directory, 'jobs'))):
+            jobId, ext = os.path.splitext(name)
+            if ext != '.json' or self.Result(jobId):
+                continue
+            try:
+                job = self.__readJson(os.path.join(self.directory, 'jobs', name))
+            except (OSError, ValueError):
+                continue # Removed by its coordinator, or still being written
+            if job['patchSrc'] not in sources:
+                continue
+            attempt = self.__lastAttempt(jobId)
+            if attempt:
+                try:
+                    age = time.time() - os.path.getmtime(self.__leasePath(jobId, attempt))
+                except OSError:
+                    continue
+                if age < self.leaseTimeout:
+                    continue
+                if attempt >= JobQueue.maxAttempts:
+                    self.Complete(jobId, {
+                        'status': 'failed', 'error': 'The job was abandoned by {} workers.'.format(attempt)})
+                    continue
+            try:
+                fd = os.open(self.__leasePath(jobId, attempt + 1), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue # Another worker claimed it first
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'worker': worker, 'claimed': time.time()}, file)
+            if attempt:
+                printLocked('### Retrying job {}, whose lease expired.'.format(jobId))
+            return job, attempt + 1
+        return None
+
+    def Renew(self, jobId, attempt):
+        '''Renews a lease, returns False if the job was claimed again since, because the lease expired'''
+        if self.__lastAttempt(jobId) != attempt:
+            return False
+        try:
+            os.utime(self.__leasePath(jobId, attempt))
+        except OSError:
+            return False
+        return True
+
+    def Expire(self, jobId, attempt):
+        '''Gives up a lease, so that the job can be claimed again right away'''
+        try:
+            os.utime(self.__leasePath(jobId, attempt), (0, 0))
+        except OSError:
+            pass
+
+    def Complete(self, jobId, result, outPath = None):
+        '''Records the result of an attempt of a job, with the patched APK.
+        Returns False if the job already has a result, or was removed by its coordinator.'''
+        if self.Result(jobId) or not os.path.exists(os.path.join(self.directory, 'jobs', jobId + '.json')):
+            return False
+        # Each attempt writes its own output, so a late attempt cannot overwrite the one of the result
+        outputPath = self.OutputPath(jobId, result.get('attempt', 0))
+        if outPath:
+            result = dict(result, output=os.path.basename(outPath))
+            fd, tempPath = tempfile.mkstemp(dir=os.path.join(self.directory, 'outputs'), prefix='.output-')
+            os.close(fd)
+            shutil.copyfile(outPath, tempPath)
+            os.replace(tempPath, outputPath)
+        # The result is not replaced if it exists, so the first result of a job wins
+        if writeJsonAtomic(
+                os.path.join(self.directory, 'results', jobId + '.json'),
+                dict(result, id=jobId, completed=time.time()), replace=False):
+            return True
+        if outPath:
+            os.remove(outputPath)
+        return False
+
+    def Result(self, jobId):
+        '''Returns the result of a job, or None if it is not finished'''
+        try:
+            return self.__readJson(os.path.join(self.directory, 'results', jobId + '.json'))
+        except (OSError, ValueError):
+            return None
+
+    def Path(self, relPath):
+        return os.path.join(self.directory, relPath)
+
+    def OutputPath(self, jobId, attempt):
+        return os.path.join(self.directory, 'outputs', '{}.{}.apk'.format(jobId, attempt))
+
+    def Remove(self, jobId):
+        '''Removes a finished job with its leases, result and output'''
+        paths = [
+            os.path.join(self.directory, 'jobs', jobId + '.json'),
+            os.path.join(self.directory, 'results', jobId + '.json'),
+            *glob.glob(os.path.join(self.directory, 'outputs', jobId + '.*.apk')),
+            *glob.glob(os.path.join(self.directory, 'leases', jobId + '.*.lease'))]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def RemoveInput(self, relPath):
+        '''Removes an APK from the queue, unless a queued job still uses it'''
+        for name in os.listdir(os.path.join(self.directory, 'jobs')):
+            try:
+                if self.__readJson(os.path.join(self.directory, 'jobs', name)).get('input') == relPath:
+                    return
+            except (OSError, ValueError):
+                continue
+        shutil.rmtree(os.path.dirname(self.Path(relPath)), ignore_errors=True)
+
+    def __lastAttempt(self, jobId):
+        leases = glob.glob(os.path.join(self.directory, 'leases', jobId + '.*.lease'))
+        return max((int(i.rsplit('.', 2)[1]) for i in leases), default=0)
+
+    def __leasePath(self, jobId, attempt):
+        return os.path.join(self.directory, 'leases', '{}.{}.lease'.format(jobId, attempt))
+
+    @staticmethod
+    def __readJson(path):
+        with open(path) as file:
+            return json.load(file)
 
 class Patcher:
     tools = ['cli', 'patches', 'integrations']
+    apkmdLock = threading.Lock() # Serializes the lazy apkmd provisioning of all patchers
 
-    def __init__(self, args):
-        self.initCliVersion(args.cli_version)
-        self.patchSrc = args.patchSrc
-        patchSourceData = patchSources[args.patchSrc]
+    def __init__(self, args, patchSrc, report = None, downloader = False, shared = None):
+        '''Prepares the tools of a patch source. Patchers of other sources in the same run pass the first one as
+        shared, to use the same caches, release lookups and memory admission.'''
+        self.report = report if report else RunReport()
+        self.patchSrc = patchSrc
+        patchSourceData = patchSources[patchSrc]
+        # The tool versions default to those configured for the patch source
+        versions = {
+            i: getattr(args, i + '_version') or patchSourceData[i]['ver'] for i in Patcher.tools if i in patchSourceData}
+        self.tools = list(Patcher.tools)
+        self.initCliVersion(versions['cli'])
         self.outPrepend = patchSourceData['prepend']
         self.outDir = args.outDir
         Patcher.__ensureDirectory(self.outDir)
@@ -313,17 +2018,76 @@ class Patcher:
         Patcher.__ensureDirectory(self.optionsDir)
         self.keystorePath = args.keystore
         Patcher.__ensureDirectory(os.path.dirname(self.keystorePath))
-        for tool in self.tools:
-            Patcher.__ensureTool(
-                self.toolsDir,
+        self.force = args.force
+        self.preflight = args.preflight
+        self.arch = args.arch
+        self.dpi = args.dpi
+        # A single job keeps the JVM's default heap limit, the resident JVMs of --jvm-worker are never limited
+        self.heapLimit = args.jobs > 1 and not args.jvm_worker
+        self.jvmWorkers = None
+        self.patchIndex = None
+        self.indexLock = threading.Lock()
+        if shared:
+            self.envCache = shared.envCache # One instance serializes the updates of the patchers built concurrently
+            self.apkCache = shared.apkCache
+            self.manifestLock = shared.manifestLock
+            self.github = shared.github
+            self.toolStore = shared.toolStore
+            self.memory = shared.memory
+            self.scratch = shared.scratch
+        else:
+            self.envCache = EnvironmentCache(os.path.join(args.toolsDir, 'environment.json'))
+            self.apkCache = ApkCache(
+                args.apk_cache if args.apk_cache else os.path.join(args.toolsDir, 'apks'),
+                args.apk_cache_size << 20) if args.apk_cache_size > 0 else None
+            self.manifestLock = threading.Lock()
+            if args.mirror:
+                self.github = ReleaseMirror(args.mirror)
+            else:
+                self.github = GithubClient(
+                    args.github_api, os.path.join(args.toolsDir, 'releases.json'),
+                    args.release_cache_ttl, refresh=args.refresh_tools, offline=args.offline,
+                    maxWait=args.github_max_wait)
+            self.toolStore = ToolStore(os.path.join(args.toolsDir, 'store'), args.tool_store_size << 20)
+            self.memory = MemoryScheduler(
+                os.path.join(args.toolsDir, 'memory-estimates.json'), args.memory_estimate, args.memory_reserve)
+            self.scratch = ScratchSpace(args.scratch or settings['scratchDirs'], args.scratch_multiplier)
+        # Provision all tools concurrently, so a cold start takes as long as the slowest download
+        provisioners = [
+            lambda tool=tool: Patcher.__ensureTool(
+                self.github, self.toolStore, self.report, self.toolsDir,
                 project=patchSourceData[tool]['proj'],
-                version=getattr(args, tool + '_version'),
+                version=versions[tool],
                 content_type_filter=patchSourceData[tool]['type'],
                 name_filter=patchSourceData[tool]['name_filter'] if 'name_filter' in patchSourceData[tool].keys() else None
-            )
-        self.toolPaths = {
-            i: glob.glob(os.path.join(self.toolsDir, '*{}*'.format(i)))[0] for i in self.tools
-        }
+            ) for tool in self.tools]
+        if downloader:
+            provisioners.append(self.__provisionApkmd)
+        startTime = time.time()
+        with concurrent.futures.ThreadPoolExecutor(len(provisioners)) as executor:
+            downloaded = sum(i.result() for i in [executor.submit(j) for j in provisioners])
+        if downloaded:
+            seconds = time.time() - startTime
+            printLocked('### Provisioned the tools: {:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'.format(
+                downloaded / 2**20, seconds, downloaded / 2**20 / max(seconds, 1e-3)))
+            self.toolStore.Collect()
+        with self.report.Stage('Tool discovery', self.toolsDir) as stage:
+            # The tool paths only change when the tools directory does
+            stamp = [EnvironmentCache.Stamp(self.toolsDir), self.tools, downloader]
+            paths = self.envCache.Get('tools:' + os.path.abspath(self.toolsDir), stamp)
+            if paths and not all(Patcher.__isTool(i) and os.path.exists(i) for i in paths.values()):
+                paths = None
+            stage['cached'] = paths is not None
+            if paths is None:
+                paths = {i: Patcher.__findTool(self.toolsDir, '*{}*'.format(i)) for i in self.tools}
+                if downloader:
+                    paths['apkmd'] = Patcher.__findTool(self.toolsDir, 'apkmd*')
+                self.envCache.Set('tools:' + os.path.abspath(self.toolsDir), stamp, paths)
+        if downloader:
+            self.apkmdPath = paths.pop('apkmd')
+        self.toolPaths = paths
+        if args.jvm_worker:
+            self.jvmWorkers = JvmWorkerPool(self.toolPaths['cli'], self.toolsDir)
 
     def initCliVersion(self, cliVersion):
         is5 = cliVersion == 'latest' or 5 <= int(re.sub(r'^v?(\d+).*$', r'\1', cliVersion))
@@ -334,14 +2098,26 @@ class Patcher:
             self.cliVersion = 4
 
     @staticmethod
-    def CheckJava():
-        try:
-            result = subprocess.run(
-                ['java', '-XshowSettings', '-version'],
-                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
-            match = re.search(
-                r'java\.class\.version = (\d+)(?:\.\d+)+', result.stderr.decode('ascii', 'ignore'))
-            if (not match or int(match[1]) < 55):
+    def CheckJava(report = None, envCache = None):
+        try:
+            with (report or RunReport()).Stage('Java check') as stage:
+                # The probe result is reused until the java executable is replaced
+                javaPath = shutil.which('java')
+                if not javaPath:
+                    raise FileNotFoundError('java')
+                stamp = [javaPath, EnvironmentCache.Stamp(os.path.realpath(javaPath))]
+                classVersion = envCache.Get('java', stamp) if envCache else None
+                stage['cached'] = classVersion is not None
+                if classVersion is None:
+                    result = runProcess(
+                        ['java', '-XshowSettings', '-version'], stage,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+                    match = re.search(
+                        r'java\.class\.version = (\d+)(?:\.\d+)+', result.stderr.decode('ascii', 'ignore'))
+                    classVersion = int(match[1]) if match else 0
+                    if envCache:
+                        envCache.Set('java', stamp, classVersion)
+            if classVersion < 55:
                 print('### The installed java version is too old. Please update it.')
                 return False
         except subprocess.CalledProcessError:
@@ -352,105 +2128,372 @@ class Patcher:
             return False
         return True
 
-    def Patch(self, srcPath, forwardedArgs = [], optionsPath = None):
+    def Patch(self, srcPath, forwardedArgs = [], optionsPath = None, package = None, preflight = True):
+        '''Patches an APK, returns the path of the patched APK or None. Unless the package is given,
+        the APK is checked against the supported packages and versions first.'''
+        srcFile = os.path.basename(srcPath)
+        with self.report.Stage('Patch', srcFile) as stage:
+            if package is None and preflight and self.preflight:
+                try:
+                    package = self.Preflight(srcPath)
+                except RuntimeError as e:
+                    printLocked('### Skipping {}: {}'.format(srcFile, e))
+                    stage['status'] = 'rejected'
+                    stage['error'] = str(e)
+                    return None
+            return self.__patch(srcPath, forwardedArgs, optionsPath, package, stage)
+
+    def Preflight(self, srcPath):
+        '''Reads the package and version of an APK without a JVM. Returns the package, or None if the manifest
+        cannot be read. Raises RuntimeError if the patches do not support the package or version.'''
+        with self.report.Stage('Preflight', os.path.basename(srcPath)) as stage:
+            try:
+                package, version = readApkManifest(srcPath)
+            except (OSError, KeyError, ValueError, IndexError, struct.error, zipfile.BadZipFile) as e:
+                printLocked('### Could not read the manifest of {}, patching it unchecked: {}'.format(os.path.basename(srcPath), e))
+                return None
+            stage.update({'package': package, 'version': version})
+            try:
+                supported = self.GetSupportedApps()
+            except subprocess.CalledProcessError:
+                printLocked('### Could not list the apps supported by the {} patches, patching {} unchecked.'.format(
+                    self.patchSrc, os.path.basename(srcPath)))
+                return package
+        if package not in supported:
+            raise RuntimeError('{} is not supported by the {} patches.'.format(package, self.patchSrc))
+        versions = supported[package]
+        if versions and version is None:
+            printLocked('### The version of {} is a resource reference, patching it unchecked.'.format(os.path.basename(srcPath)))
+        elif versions and version not in versions:
+            raise RuntimeError('{} {} is not supported by the {} patches, only {}.'.format(
+                package, version, self.patchSrc, ', '.join(sorted(versions, key=lambda v: tuple(map(int, v.split('.')))))))
+        return package
+
+    def __patch(self, srcPath, forwardedArgs, optionsPath, package, stage):
         srcFile = os.path.basename(srcPath)
         outPath = os.path.join(self.outDir, self.outPrepend + srcFile)
-        optionsFile = optionsPath if optionsPath else os.path.splitext(Patcher.__normalFileName(srcFile))[0] + '.json'
-        tempDir = os.path.join(tempfile.gettempdir(), 'revanced-resource-cache')
-        print('### Patching {}...'.format(srcFile))
-        cmd = ['java', '-jar', self.toolPaths['cli'], 'patch']
+        optionsFile = optionsPath if optionsPath else self.__optionsFileName(srcFile, package)
+        cmd = ['patch']
         cmd += self._getPatchOptions(forwardedArgs, optionsFile)
-        cmd += [
-            '--keystore=' + self.keystorePath,
-            '--temporary-files-path=' + tempDir,
-            '--out=' + outPath, srcPath]
-        try:
-            subprocess.run(cmd, stdout=sys.stdout, stderr=sys.stderr, check=True)
-            print('### Finished patching {} successfully!'.format(os.path.abspath(outPath)))
-        except subprocess.CalledProcessError:
-            print('### Failed to patch {}!'.format(srcFile))
+        cmd += ['--keystore=' + self.keystorePath, '--out=' + outPath, srcPath]
+        if not self.force and os.path.exists(outPath) and \
+           self.__readManifest().get(os.path.basename(outPath)) == self.__fingerprint(cmd):
+            printLocked('### {} is up to date, skipping.'.format(os.path.abspath(outPath)))
+            stage['status'] = 'skipped'
+            return outPath
+        # The memory estimates are kept per package, or per version-less file name if it is unknown
+        memoryKey = package if package else os.path.splitext(Patcher.__normalFileName(srcFile))[0]
+        result = None
+        with self.memory.Admit(memoryKey, stage) as budget:
+            heapMiB = budget if self.heapLimit else None
+            tempDir = self.scratch.Acquire(
+                int(os.path.getsize(srcPath) * self.scratch.multiplier), 'revanced-resource-cache-', srcFile, stage)
+            printLocked('### Patching {}...'.format(srcFile))
+            # The CLI output is timestamped, to break the run down to phases and patches
+            parser = CliOutputParser()
+            try:
+                self.__runCli(
+                    cmd[:-1] + ['--temporary-files-path=' + tempDir, srcPath],
+                    stage=stage, javaArgs=['-Xmx{}m'.format(heapMiB)] if heapMiB else [], onLine=parser.Feed)
+                printLocked('### Finished patching {} successfully!'.format(os.path.abspath(outPath)))
+                result = outPath
+            except subprocess.CalledProcessError as e:
+                printLocked('### Failed to patch {}!'.format(srcFile))
+                stage['status'] = 'failed'
+                stage['error'] = 'The patch command exited with status {}.'.format(e.returncode)
+            finally:
+                # Purge the temp directory after patching (the built-in purger likes to fail)
+                self.scratch.Release(tempDir)
+            stage.update(parser.Timings(), package=package, bundle=os.path.basename(self.toolPaths['patches']))
+            self.memory.Record(memoryKey, stage, heapMiB, result is not None)
+        self.__updateManifest(os.path.basename(outPath), self.__fingerprint(cmd) if result else None)
+        return result
+
+    def __fingerprint(self, cmd):
+        '''Returns a digest of the patch command and the contents of the files it uses'''
+        files = {}
+        for arg in [self.toolPaths['cli']] + cmd[:-1]:
+            if arg.startswith('--out='):
+                continue
+            path = arg.split('=', 1)[1] if arg.startswith('-') and '=' in arg else arg
+            if os.path.isfile(path):
+                files[arg] = fileHash(path)
+        # The source APK is known by its contents only, downloads land in a new directory on each run
+        files['source'] = fileHash(cmd[-1])
+        return hashlib.sha256(json.dumps([cmd[:-1], files], sort_keys=True).encode()).hexdigest()
+
+    def __readManifest(self):
+        '''Returns the fingerprints of the outputs from the build manifest next to them'''
         try:
-            # Purge the temp directory after patching (the built-in purger likes to fail)
-            shutil.rmtree(tempDir)
-        except:
-            pass
+            with open(os.path.join(self.outDir, 'patch-manifest.json')) as file:
+                manifest = json.load(file)
+            seedFileHashes(manifest.get('hashes', {}))
+            return manifest.get('outputs', {})
+        except (OSError, ValueError):
+            return {}
+
+    def __updateManifest(self, outFile, fingerprint):
+        with self.manifestLock:
+            outputs = self.__readManifest()
+            if fingerprint:
+                outputs[outFile] = fingerprint
+            else:
+                outputs.pop(outFile, None)
+            writeJsonAtomic(
+                os.path.join(self.outDir, 'patch-manifest.json'),
+                {'outputs': outputs, 'hashes': fileHashRecords()}, indent=1)
 
     def DownloadAndPatch(self, appId, forwardedArgs = []):
         apkPath = self.Download(appId)
-        if apkPath:
-            self.Patch(
+        if not apkPath:
+            return None
+        return self.PatchDownloaded(appId, apkPath, forwardedArgs=forwardedArgs)
+
+    def PatchDownloaded(self, appId, apkPath, forwardedArgs = [], release = True):
+        '''Patches an APK downloaded for the app, then releases the download unless release is False'''
+        try:
+            return self.Patch(
                 apkPath, forwardedArgs=forwardedArgs,
-                optionsPath=os.path.join(scriptDir, appId + '.json'))
+                optionsPath=os.path.join(self.optionsDir, appId + '.json'), package=appMap[appId]['package'])
+        finally:
+            if release:
+                self.ReleaseDownload(apkPath)
+
+    def ReleaseDownload(self, apkPath):
+        '''Deletes a downloaded APK which is no longer needed, unless it is cached'''
+        if self.apkCache and self.apkCache.Owns(apkPath):
+            self.apkCache.Release(apkPath)
+        else:
             os.remove(apkPath)
+            Patcher.__removeEmptyDirectory(os.path.dirname(apkPath))
 
     def Download(self, appId):
-        self.__ensureApkmd()
+        try:
+            appVer = self.ResolveVersion(appId)
+        except RuntimeError as e:
+            printLocked('### Error: {}'.format(e))
+            return None
+        return self.DownloadVersion(appId, appVer)
+
+    def ResolveVersion(self, appId):
+        '''Returns the newest app version supported by the patches, or None if any version works'''
+        return newestVersion(self.SupportedVersions(appId))
 
-        appData = appMap[appId]
+    def SupportedVersions(self, appId):
+        '''Returns the app versions supported by the patches, an empty list if any version works'''
         try:
-            appVer = self.__getAppVersion(appData['package'])
+            return self.__getAppVersions(appMap[appId]['package'])
         except subprocess.CalledProcessError:
-            print('### Error: The patcher could not be called.'.format(appId))
-            return None
+            raise RuntimeError('The patcher could not be called.')
         except RuntimeError:
-            print('### Error: {} is not supported by the patcher.'.format(appId))
-            return None
-        apkmdConfig = {
-            'apps': [{
+            raise RuntimeError('{} is not supported by the {} patches.'.format(appId, self.patchSrc))
+
+    def DownloadVersion(self, appId, appVer):
+        '''Downloads the given version of the app, returns the path of the APK or None'''
+        return self.DownloadVersions([(appId, appVer)])[appId]
+
+    def DownloadMany(self, appIds):
+        '''Resolves the versions of the apps, then downloads them with one apkmd call.
+        Returns the paths of the APKs by app, None for apps that failed.'''
+        apps = []
+        paths = {}
+        for appId in appIds:
+            try:
+                apps.append((appId, self.ResolveVersion(appId)))
+            except RuntimeError as e:
+                printLocked('### Error: {}'.format(e))
+                paths[appId] = None
+        paths.update(self.DownloadVersions(apps))
+        return paths
+
+    def DownloadVersions(self, apps):
+        '''Downloads the given (app, version) pairs with one apkmd call.
+        Returns the paths of the APKs by app, None for apps that failed.'''
+        apps = dict(apps)
+        if not apps:
+            return {}
+        self.__ensureApkmd()
+        with self.report.Stage('Download', ', '.join(apps.keys())) as stage:
+            paths = self.__download(apps, stage)
+            if not all(paths.values()):
+                stage['status'] = 'failed'
+            return paths
+
+    def __download(self, apps, stage):
+        paths = {}
+        cacheKeys = {}
+        apkmdConfig = {'apps': []}
+        for appId, appVer in apps.items():
+            appData = appMap[appId]
+            arch = appData['arch'] if 'arch' in appData.keys() else self.arch
+            dpi = appData['dpi'] if 'dpi' in appData.keys() else self.dpi
+            if self.apkCache and appVer:
+                cacheKeys[appId] = ApkCache.Key(appData['package'], appVer, arch, dpi)
+                path = self.apkCache.Get(cacheKeys[appId])
+                if path:
+                    printLocked('### Using the cached download of {} {}.'.format(appId, appVer))
+                    stage.setdefault('cacheHits', []).append(appId)
+                    paths[appId] = path
+                    continue
+            config = {
                 'outFile': '{} {}'.format(appId, appVer if appVer else 'latest'),
                 'org': appData['org'],
                 'repo': appData['repo'],
-                'arch': appData['arch'] if 'arch' in appData.keys() else settings['download']['arch'],
-                'dpi': appData['dpi'] if 'dpi' in appData.keys() else settings['download']['dpi']
-            }]
-        }
-        for config in apkmdConfig['apps']:
-            if 'arch' in config.keys() and config['arch'] not in ['universal', 'noarch']:
+                'arch': arch,
+                'dpi': dpi
+            }
+            if config['arch'] not in ['universal', 'noarch']:
                 config.update({'fallbackArch': 'universal'})
             if appVer != None:
                 config.update({'version': appVer})
+            apkmdConfig['apps'].append(config)
+            printLocked('### Downloading {}...'.format(appId + (' ' + appVer if appVer else '')))
+        if not apkmdConfig['apps']:
+            return paths
 
-        print('### Downloading {}...'.format(appId + (' ' + appVer if appVer else '')))
-
+        # Each batch downloads to its own directory, so concurrent batches cannot collide
+        downloadDir = self.scratch.Acquire(
+            len(apkmdConfig['apps']) * ScratchSpace.downloadSize, 'apkmd-',
+            'the download of {} apps'.format(len(apkmdConfig['apps'])), stage)
         fd, configPath = tempfile.mkstemp(suffix='.json')
         with os.fdopen(fd, 'w') as file:
             json.dump(apkmdConfig, file)
 
         try:
             # Try downloading the correct arch version
-            subprocess.run(
-                [self.apkmdPath, configPath], cwd=tempfile.gettempdir(),
-                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                check=True)
-            path = os.path.join(
-                tempfile.gettempdir(), apkmdConfig['apps'][0]['outFile'] + '.apk')
-            if not os.path.exists(path):
-                print('### Failed to find a correct version of {} or blocked by server!'.format(appId))
-                return None
-            return path
-        except subprocess.CalledProcessError:
-            print('### Failed to download {}!'.format(appId))
-            return None
+            result = runProcess(
+                [self.apkmdPath, configPath], stage, cwd=downloadDir,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         finally:
             os.remove(configPath)
+        for appId, config in zip([i for i in apps.keys() if i not in paths], apkmdConfig['apps']):
+            path = os.path.join(downloadDir, config['outFile'] + '.apk')
+            if not os.path.exists(path):
+                if result.returncode != 0:
+                    printLocked('### Failed to download {}!'.format(appId))
+                else:
+                    printLocked('### Failed to find a correct version of {} or blocked by server!'.format(appId))
+                paths[appId] = None
+            elif appId in cacheKeys:
+                paths[appId] = self.apkCache.Add(cacheKeys[appId], path)
+            else:
+                paths[appId] = path
+        # The APKs which are not cached stay in the directory until they are patched
+        self.scratch.Release(downloadDir, remove=False)
+        Patcher.__removeEmptyDirectory(downloadDir)
+        return paths
+
+    @staticmethod
+    def __removeEmptyDirectory(directory):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
 
-    def __getAppVersion(self, appPackage):
-        result = subprocess.run([
-            'java', '-jar',
-            self.toolPaths['cli'], 'list-patches',
-            '--filter-package-name=' + appPackage,
-            '--with-versions',
-            '--with-packages',
-            self.toolPaths['patches']
-        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
-        output = result.stdout.decode('ascii', 'ignore')
-        if not appPackage in output:
+    def __getAppVersions(self, appPackage):
+        with self.report.Stage('Version lookup', appPackage):
+            packages = self.GetSupportedApps()
+        if appPackage not in packages:
             raise RuntimeError("App unsupported by patcher.")
-        versions = re.findall(r'^\s*(\d+\.\d+(?:\.\d+)*)\s*$', output, re.MULTILINE)
-        versions = [x.split('.') for x in versions]
-        if not versions:
-            return None
-        return '.'.join(max(versions, key=lambda t: tuple(map(int, t))))
+        return packages[appPackage]
+
+    def GetSupportedApps(self):
+        '''Returns the packages supported by the patches, mapped to their supported versions'''
+        with self.indexLock:
+            if self.patchIndex is None:
+                self.patchIndex = self.__loadPatchIndex()
+            return self.patchIndex
+
+    def ListSupported(self):
+        '''Prints the apps supported by the patches'''
+        appNames = {data['package']: appId for appId, data in appMap.items()}
+        for package, versions in sorted(self.GetSupportedApps().items()):
+            versions = sorted(versions, key=lambda v: tuple(map(int, v.split('.'))), reverse=True)
+            print('{}{}: {}'.format(
+                package, ' ({})'.format(appNames[package]) if package in appNames else '',
+                ', '.join(versions) if versions else 'any version'))
+
+    def __loadPatchIndex(self):
+        '''Loads the patch compatibility index of the patches bundle, or builds it with one list-patches call'''
+        # Hidden, so that it is not mistaken for the patches bundle
+        indexPath = os.path.join(self.toolsDir, '.patch-index.json')
+        patchesPath = self.toolPaths['patches']
+        key = {'patches': fileHash(patchesPath), 'cli': os.path.basename(self.toolPaths['cli'])}
+        try:
+            with open(indexPath) as file:
+                index = json.load(file)
+            if index['key'] == key:
+                return index['packages']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with self.report.Stage('list-patches', os.path.basename(patchesPath)) as stage:
+            output = self.__runCli([
+                'list-patches',
+                '--with-versions',
+                '--with-packages',
+                patchesPath
+            ], capture=True, stage=stage)
+        packages = Patcher.__parsePatchList(output)
+        writeJsonAtomic(indexPath, {'key': key, 'packages': packages})
+        return packages
+
+    def __runCli(self, cliArgs, capture = False, stage = None, javaArgs = [], onLine = None):
+        '''Runs a CLI command in a JVM worker or a new java process with the given java options.
+        Returns the captured standard output, or shows it on the console, also passing its lines to onLine.'''
+        def forward(line):
+            with _printLock:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            onLine(line)
+
+        if self.jvmWorkers:
+            outPath = None
+            if capture:
+                fd, outPath = tempfile.mkstemp(suffix='.txt')
+                os.close(fd)
+            try:
+                status = self.jvmWorkers.Run(cliArgs, outPath, forward if onLine and not capture else None)
+                if status is not None:
+                    if stage is not None:
+                        stage['jvmWorker'] = True
+                    if status != 0:
+                        raise subprocess.CalledProcessError(status, cliArgs)
+                    if capture:
+                        with open(outPath, 'rb') as file:
+                            return file.read().decode('ascii', 'ignore')
+                    return None
+            finally:
+                if outPath:
+                    os.remove(outPath)
+        cmd = ['java'] + javaArgs + ['-jar', self.toolPaths['cli']] + cliArgs
+        if capture:
+            result = runProcess(cmd, stage, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            return result.stdout.decode('ascii', 'ignore')
+        if onLine:
+            runProcess(cmd, stage, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True, onLine=forward)
+        else:
+            runProcess(cmd, stage, stdout=sys.stdout, stderr=sys.stderr, check=True)
+        return None
+
+    @staticmethod
+    def __parsePatchList(output):
+        '''Collects the compatible packages and versions from the output of list-patches'''
+        packages = {}
+        package = None
+        for line in output.splitlines():
+            match = re.match(r'^\s*Package name:\s*(\S+)\s*$', line)
+            if match:
+                package = match[1]
+                packages.setdefault(package, [])
+                continue
+            match = re.match(r'^\s*(\d+\.\d+(?:\.\d+)*)\s*$', line)
+            if match and package:
+                if match[1] not in packages[package]:
+                    packages[package].append(match[1])
+            elif re.match(r'^\S', line):
+                package = None # A new patch begins
+        return packages
 
     def _getPatchOptions(self, forwardedArgs, optionsPath):
         cmd = []
@@ -477,48 +2520,78 @@ class Patcher:
             except FileExistsError:
                 pass
 
+    def __optionsFileName(self, srcFile, package):
+        '''Returns the options file name of an APK: the app name for known packages, or the package name.
+        The name guessed from the file name is used if the manifest could not be read,
+        or if only an options file of that older name exists.'''
+        fileName = os.path.splitext(Patcher.__normalFileName(srcFile))[0] + '.json'
+        if not package:
+            return fileName
+        packageName = next((i for i, data in appMap.items() if data['package'] == package), package) + '.json'
+        if not os.path.exists(os.path.join(self.optionsDir, packageName)) and \
+           os.path.exists(os.path.join(self.optionsDir, fileName)):
+            return fileName
+        return packageName
+
     @staticmethod
     def __normalFileName(path):
         '''Removes version strings from the file name'''
         regex = r'\b\s*v?\d+(?:\.\d+)*(?:-[^\s]*)?\b'
         return re.sub(regex, '', path)
 
+    @staticmethod
+    def __isTool(path):
+        '''Returns whether a file in a tools directory is a tool, not an index or a partial download'''
+        return not os.path.basename(path).startswith('.') and not path.endswith(('.json', '.part', '.link'))
+
+    @staticmethod
+    def __findTool(directory, pattern):
+        '''Returns the path of the tool matching the glob pattern in the directory'''
+        return next(i for i in sorted(glob.glob(os.path.join(directory, pattern))) if Patcher.__isTool(i))
+
     def __ensureApkmd(self):
-        if hasattr(self, 'apkmdPath'):
-            return
-        Patcher.__ensureTool(
-            self.toolsDir,
-            project='tanishqmanuja/apkmirror-downloader',
+        '''Provisions apkmd on first use. The patchers download it into the shared tool store one at a time.'''
+        with Patcher.apkmdLock:
+            if hasattr(self, 'apkmdPath'):
+                return
+            self.__provisionApkmd()
+            self.apkmdPath = Patcher.__findTool(self.toolsDir, 'apkmd*')
+
+    def __provisionApkmd(self):
+        return Patcher.__ensureTool(
+            self.github, self.toolStore, self.report, self.toolsDir,
+            project=apkmdTool['proj'],
             version='latest',
-            name_filter='apkmd.exe' if os.name == 'nt' else 'apkmd' if os.name == 'posix' else None
+            name_filter=apkmdTool['name_filter'],
+            executable=True
         )
-        self.apkmdPath = glob.glob(os.path.join(self.toolsDir, 'apkmd*'))[0]
 
     @staticmethod
     def __ensureTool(
-        directory, project, version = 'latest',
-        content_type_filter = None, name_filter = None):
-        '''Prepares one ReVanced tool'''
+        github, store, report, directory, project, version = 'latest',
+        content_type_filter = None, name_filter = None, executable = False):
+        '''Prepares one ReVanced tool from the tool store, downloading it into the store if needed.
+        Returns the number of downloaded bytes.'''
 
         def clearExistingTools(directory, assetName):
-            '''Deletes older versions of the given tool'''
+            '''Deletes the links of other versions of the given tool, which stay in the tool store'''
             regex = r'^([^\d]{3,})v?\d+(?:\.\d+(?:\.\d+)?)?[^\d]*(\.[^\.]+)$'
             assetGlob = re.sub(regex, r'\1*.*', assetName)
             for file in [*glob.glob(os.path.join(directory, assetGlob)),
                          *glob.glob(os.path.join(directory, 'revanced-' + assetGlob))]:
-                os.remove(file)
+                if os.path.basename(file) != assetName and Patcher.__isTool(file):
+                    os.remove(file)
 
-        if version != 'latest':
-            version = 'tags/v' + version.lstrip('v')
-        url = 'https://api.github.com/repos/{0}/releases/{1}'.format(project, version)
-        releaseData = json.loads(urllib.request.urlopen(url).read())
-        assets = [i for i in releaseData['assets']
-            if (not content_type_filter or
-                re.match('^{}$'.format(content_type_filter), i['content_type'])) and
-               (not name_filter or re.match('^{}$'.format(name_filter), i['name']))]
+        # A pinned version which is already in the store is resolved without the GitHub API
+        releaseData = store.GetRelease(project, version) if version != 'latest' else None
+        assets = selectAssets(releaseData, content_type_filter, name_filter) if releaseData else []
+        if not assets:
+            with report.Stage('GitHub API', project):
+                releaseData = github.GetRelease(project, version)
+            assets = selectAssets(releaseData, content_type_filter, name_filter)
         if not assets:
-            print('### Error: No suitable asset found for tool {}!'.format(project))
-            exit(2)
+            raise RuntimeError('No suitable asset found for tool {}!'.format(project))
+        totalDownloaded = 0
         for asset in assets:
             assetName = asset['name']
             assetVer = releaseData['tag_name'].lstrip('v')
@@ -526,15 +2599,36 @@ class Patcher:
                 assetName = os.path.splitext(assetName)
                 assetName = ''.join((assetName[0], '-', assetVer, assetName[1]))
             assetPath = os.path.join(directory, assetName)
-            if (not os.path.exists(assetPath)):
-                print('### Downloading tool {}...'.format(assetName))
-                Patcher.__ensureDirectory(directory)
-                clearExistingTools(directory, assetName)
-                assetUrl = asset['browser_download_url']
-                urllib.request.urlretrieve(assetUrl, assetPath)
+            if os.path.exists(assetPath):
+                continue
+            Patcher.__ensureDirectory(directory)
+            sha256 = store.Lookup(project, releaseData['tag_name'], asset)
+            if not sha256 or not store.Has(sha256):
+                if github.offline:
+                    raise RuntimeError('{} is not in the tool store, and cannot be downloaded offline.'.format(assetName))
+                printLocked('### Downloading tool {}...'.format(assetName))
+                with report.Stage('Tool download', assetName) as stage:
+                    downloadPath = store.store.Path('.' + assetName)
+                    downloaded, resumed, seconds = downloadFile(
+                        asset['browser_download_url'], downloadPath, size=asset.get('size'),
+                        digest=asset.get('digest'), executable=executable, pool=github.http)
+                    stage.update({'bytes': downloaded, 'resumedBytes': resumed})
+                printLocked('### Downloaded {}: {:.1f} MiB in {:.1f}s ({:.1f} MiB/s{})'.format(
+                    assetName, downloaded / 2**20, seconds, downloaded / 2**20 / max(seconds, 1e-3),
+                    ', {:.1f} MiB resumed'.format(resumed / 2**20) if resumed else ''))
+                totalDownloaded += downloaded
+                sha256 = store.Add(project, releaseData['tag_name'], asset, downloadPath)
+            else:
+                printLocked('### Using tool {} from the tool store.'.format(assetName))
+                if not store.Find(project, releaseData['tag_name'], asset['name']):
+                    store.Index(project, releaseData['tag_name'], asset, sha256)
+            store.Link(sha256, assetPath, executable)
+            clearExistingTools(directory, assetName)
+        return totalDownloaded
 
 class MorphePatcher(Patcher):
     def initCliVersion(self, cliVersion):
+        self.cliVersion = 5
         self.tools.remove('integrations') # Morphe never used integrations
 
     def _getPatchOptions(self, forwardedArgs, optionsPath):
@@ -542,13 +2636,544 @@ class MorphePatcher(Patcher):
         cmd += forwardedArgs
         return cmd
 
-def makePatcher(args):
-    if args.patchSrc == 'morphe':
-        return MorphePatcher(args)
+def makePatcher(args, patchSrc, report = None, downloader = False, shared = None):
+    if patchSrc == 'morphe':
+        return MorphePatcher(args, patchSrc, report, downloader, shared)
     else:
-        return Patcher(args)
+        return Patcher(args, patchSrc, report, downloader, shared)
 
-def main():
+def makePatchers(args, report = None, downloader = False):
+    '''Returns a patcher for each selected patch source. The first one downloads the apps, the others share its caches.'''
+    first = makePatcher(args, args.patchSrc[0], report, downloader)
+    with concurrent.futures.ThreadPoolExecutor(max(len(args.patchSrc) - 1, 1)) as executor:
+        others = list(executor.map(lambda i: makePatcher(args, i, report, shared=first), args.patchSrc[1:]))
+    return [first] + others
+
+def newestVersion(versions):
+    '''Returns the newest of the dotted version numbers, or None if there are none'''
+    if not versions:
+        return None
+    return max(versions, key=lambda v: tuple(map(int, v.split('.'))))
+
+def resolveVersions(patchers, appId):
+    '''Groups the patchers by the app version to download for them: the newest version supported by all of them
+    where one exists, otherwise the newest version supported by each. Returns the groups by version, and the errors
+    of the patchers which do not support the app.'''
+    supported = {}
+    errors = {}
+    for patcher in patchers:
+        try:
+            supported[patcher] = patcher.SupportedVersions(appId)
+        except RuntimeError as e:
+            errors[patcher] = str(e)
+    constrained = [set(i) for i in supported.values() if i]
+    common = set.intersection(*constrained) if constrained else set()
+    if constrained and not common:
+        printLocked('### No version of {} is supported by all the patch sources, downloading several versions.'.format(appId))
+    groups = {}
+    for patcher, versions in supported.items():
+        if common or not constrained:
+            version = newestVersion(common)
+        else:
+            version = newestVersion(versions or constrained[0])
+        groups.setdefault(version, []).append(patcher)
+    return groups, errors
+
+def runPipeline(patchers, inputs, forwardedArgs, jobs):
+    '''Patches the inputs with each patcher, with concurrent version resolution, download and patch stages.
+    Each app is downloaded once for all patchers where their supported versions allow. Returns the number of failures.'''
+    results = [{} for _ in inputs]
+    downloadQueue = queue.Queue(maxsize=jobs)
+    patchQueue = queue.Queue(maxsize=jobs)
+
+    def fail(index, patchers, error):
+        for patcher in patchers:
+            results[index][patcher.patchSrc] = (None, error)
+
+    def resolveStage():
+        try:
+            # The local APKs are checked first, so that rejected ones never start a JVM
+            files = []
+            for index, path in enumerate(inputs):
+                if path in appMap.keys():
+                    continue
+                for patcher in patchers:
+                    try:
+                        package = patcher.Preflight(path) if patcher.preflight else None
+                    except RuntimeError as e:
+                        printLocked('### Skipping {}: {}'.format(path, e))
+                        fail(index, [patcher], 'rejected by the preflight check')
+                        continue
+                    files.append((index, path, package, patcher))
+            # The largest jobs are started first, the smaller ones fill the remaining memory
+            files.sort(key=lambda i: -i[3].memory.Budget(i[2]))
+            for index, path, package, patcher in files:
+                patchQueue.put((index, path, None, patcher, None, package))
+            for index, path in enumerate(inputs):
+                if path not in appMap.keys():
+                    continue
+                groups, errors = resolveVersions(patchers, path)
+                for patcher, error in errors.items():
+                    printLocked('### Error: {}'.format(error))
+                    fail(index, [patcher], 'version resolution failed')
+                for appVer, group in groups.items():
+                    downloadQueue.put((index, path, appVer, group))
+        finally:
+            downloadQueue.put(None)
+
+    def downloadStage():
+        try:
+            finished = False
+            while not finished:
+                # Download the apps resolved so far in one batch
+                batch = [downloadQueue.get()]
+                while len(batch) < jobs and batch[-1] is not None:
+                    try:
+                        batch.append(downloadQueue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    finished = True
+                    batch.pop()
+                while batch:
+                    # The same app may only be downloaded once per apkmd call
+                    pending = [i for n, i in enumerate(batch) if i[1] not in [j[1] for j in batch[:n]]]
+                    batch = [i for i in batch if i not in pending]
+                    try:
+                        apkPaths = patchers[0].DownloadVersions([(i[1], i[2]) for i in pending])
+                    except Exception as e:
+                        printLocked('### Failed to download {}: {}'.format(', '.join(i[1] for i in pending), e))
+                        apkPaths = {}
+                    for index, appId, _, group in pending:
+                        if not apkPaths.get(appId):
+                            fail(index, group, 'download failed')
+                            continue
+                        # The download is released by the last patch job which uses it
+                        users = [len(group), threading.Lock()]
+                        for patcher in group:
+                            patchQueue.put((index, apkPaths[appId], appId, patcher, users, None))
+        finally:
+            for _ in range(jobs):
+                patchQueue.put(None)
+
+    def patchStage():
+        while True:
+            item = patchQueue.get()
+            if item is None:
+                break
+            index, apkPath, appId, patcher, users, package = item
+            try:
+                if appId:
+                    outPath = patcher.PatchDownloaded(appId, apkPath, forwardedArgs=forwardedArgs, release=False)
+                else:
+                    outPath = patcher.Patch(apkPath, forwardedArgs=forwardedArgs, package=package, preflight=False)
+                results[index][patcher.patchSrc] = (outPath, None if outPath else 'patching failed')
+            except Exception as e:
+                printLocked('### Failed to patch {}: {}'.format(apkPath, e))
+                results[index][patcher.patchSrc] = (None, 'patching failed')
+            if users:
+                with users[1]:
+                    users[0] -= 1
+                    if not users[0]:
+                        patcher.ReleaseDownload(apkPath)
+
+    threads = [threading.Thread(target=resolveStage), threading.Thread(target=downloadStage)]
+    threads += [threading.Thread(target=patchStage) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('### Summary:')
+    failures = 0
+    for path, outcomes in zip(inputs, results):
+        for patcher in patchers:
+            outPath, error = outcomes.get(patcher.patchSrc, (None, 'not patched'))
+            name = path if len(patchers) == 1 else '{} [{}]'.format(path, patcher.patchSrc)
+            if outPath:
+                print('###   OK      {} -> {}'.format(name, os.path.abspath(outPath)))
+            else:
+                failures += 1
+                print('###   FAILED  {} ({})'.format(name, error))
+    return failures
+
+def watchDirectory(patchers, directory, forwardedArgs, jobs, settle, pollInterval, report = None, reportPath = None):
+    '''Patches the APKs written to the directory with each patcher until interrupted,
+    with up to the given number of concurrent jobs'''
+    # Patched outputs are excluded, in case they are written to the watched directory
+    watcher = DirectoryWatcher(
+        directory, settle, pollInterval, exclude=[i['prepend'] for i in patchSources.values()])
+    patchQueue = queue.Queue()
+    queued = set()
+    counters = {'queued': 0, 'running': 0, 'patched': 0, 'failed': 0, 'seconds': 0.0}
+    lock = threading.Lock()
+    startTime = time.time()
+
+    def printStatus():
+        with lock:
+            hours = max(time.time() - startTime, 1.0) / 3600
+            status = dict(counters, queueDepth=patchQueue.qsize(), perHour=round(counters['patched'] / hours, 1))
+        printLocked('### Watch: {} queued, {} running, {} patched, {} failed, {:.1f} APKs/hour'.format(
+            status['queueDepth'], status['running'], status['patched'], status['failed'], status['perHour']))
+        if reportPath:
+            report.counters['watch'] = status
+            report.Write(reportPath)
+
+    def patchStage():
+        while True:
+            item = patchQueue.get()
+            if item is None:
+                break
+            path, patcher = item
+            with lock:
+                queued.discard(item)
+                counters['running'] += 1
+            jobStart = time.perf_counter()
+            try:
+                outPath = patcher.Patch(path, forwardedArgs=forwardedArgs)
+            except Exception as e:
+                printLocked('### Failed to patch {}: {}'.format(path, e))
+                outPath = None
+            with lock:
+                counters['running'] -= 1
+                counters['patched' if outPath else 'failed'] += 1
+                counters['seconds'] = round(counters['seconds'] + time.perf_counter() - jobStart, 3)
+            printStatus()
+
+    threads = [threading.Thread(target=patchStage) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    print('### Watching {} for APKs ({}). Press Ctrl+C to stop.'.format(os.path.abspath(directory), watcher.Mode()))
+    try:
+        while True:
+            for path in watcher.Wait():
+                for patcher in patchers:
+                    with lock:
+                        # An APK that changes again before it is patched is only patched once
+                        if (path, patcher) in queued:
+                            continue
+                        queued.add((path, patcher))
+                        counters['queued'] += 1
+                    patchQueue.put((path, patcher))
+    except KeyboardInterrupt:
+        print('### Stopping, the running jobs are finished first.')
+        while True:
+            try:
+                patchQueue.get_nowait()
+            except queue.Empty:
+                break
+    finally:
+        for _ in threads:
+            patchQueue.put(None)
+        for thread in threads:
+            thread.join()
+        watcher.Close()
+    printStatus()
+
+def coordinateQueue(patchers, queueDir, inputs, forwardedArgs, outDir, leaseTimeout, pollInterval):
+    '''Publishes a job for each input and patcher to the queue, then waits for the workers to finish them,
+    and moves the patched APKs to the output directory. Returns the number of failures.'''
+    jobQueue = JobQueue(queueDir, leaseTimeout)
+    jobs = {}
+    failures = []
+    added = set()
+    for path in inputs:
+        if path in appMap.keys():
+            groups, errors = resolveVersions(patchers, path)
+            failures += [(path, i.patchSrc, j) for i, j in errors.items()]
+            published = [({'app': path, 'version': i}, j) for i, group in groups.items() for j in group]
+        else:
+            relPath = jobQueue.AddInput(path)
+            added.add(relPath)
+            published = [({'input': relPath}, i) for i in patchers]
+        for job, patcher in published:
+            job.update(patchSrc=patcher.patchSrc, forwardedArgs=forwardedArgs)
+            jobs[jobQueue.Publish(job)] = (path, patcher.patchSrc)
+    print('### Published {} jobs to {}, waiting for the workers...'.format(len(jobs), os.path.abspath(queueDir)))
+
+    outcomes = {}
+    while len(outcomes) < len(jobs):
+        for jobId, (path, patchSrc) in jobs.items():
+            result = None if jobId in outcomes else jobQueue.Result(jobId)
+            if not result:
+                continue
+            if result['status'] in ('ok', 'skipped'):
+                outPath = os.path.join(outDir, result['output'])
+                shutil.move(jobQueue.OutputPath(jobId, result['attempt']), outPath)
+                print('### {} [{}] was patched by {} in {:.1f}s.'.format(path, patchSrc, result['worker'], result['seconds']))
+                outcomes[jobId] = (outPath, None)
+            else:
+                print('### {} [{}] failed: {}'.format(path, patchSrc, result['error']))
+                outcomes[jobId] = (None, result['error'])
+            jobQueue.Remove(jobId)
+        if len(outcomes) < len(jobs):
+            time.sleep(pollInterval)
+    for relPath in added:
+        jobQueue.RemoveInput(relPath)
+
+    print('### Summary:')
+    for jobId, (path, patchSrc) in jobs.items():
+        outPath, error = outcomes[jobId]
+        name = path if len(patchers) == 1 else '{} [{}]'.format(path, patchSrc)
+        if outPath:
+            print('###   OK      {} -> {}'.format(name, os.path.abspath(outPath)))
+        else:
+            print('###   FAILED  {} ({})'.format(name, error))
+    for path, patchSrc, error in failures:
+        print('###   FAILED  {} [{}] ({})'.format(path, patchSrc, error))
+    return len(failures) + sum(1 for i in outcomes.values() if not i[0])
+
+def workQueue(patchers, queueDir, jobs, leaseTimeout, pollInterval):
+    '''Claims and runs the jobs of the patchers' patch sources from the queue until interrupted,
+    with up to the given number of concurrent jobs. The leases of the running jobs are renewed in the background,
+    and a job whose lease was lost to another worker is cancelled.'''
+    jobQueue = JobQueue(queueDir, leaseTimeout)
+    bySource = {i.patchSrc: i for i in patchers}
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    running = {}
+    lock = threading.Lock()
+    stopping = threading.Event()
+
+    def run(job):
+        patcher = bySource[job['patchSrc']]
+        if 'app' in job:
+            apkPath = patcher.DownloadVersion(job['app'], job['version'])
+            if not apkPath:
+                raise RuntimeError('The download of {} {} failed.'.format(job['app'], job['version']))
+            return patcher.PatchDownloaded(job['app'], apkPath, forwardedArgs=job['forwardedArgs'])
+        return patcher.Patch(jobQueue.Path(job['input']), forwardedArgs=job['forwardedArgs'])
+
+    def workStage():
+        while not stopping.is_set():
+            claim = jobQueue.Claim(worker, bySource.keys())
+            if not claim:
+                stopping.wait(pollInterval)
+                continue
+            job, attempt = claim
+            handle = Job()
+            with lock:
+                running[job['id']] = (attempt, handle)
+            printLocked('### Running job {} (attempt {}).'.format(job['id'], attempt))
+            startTime = time.perf_counter()
+            result = {'status': 'ok', 'error': None, 'worker': worker, 'attempt': attempt}
+            outPath = None
+            try:
+                outPath = handle.Run(run, job)
+            except Exception as e:
+                result.update(status='error', error=str(e))
+            with lock:
+                del running[job['id']]
+            patches = [i for i in handle.stages if i['stage'] == 'Patch']
+            if result['status'] == 'ok' and patches and patches[-1]['status'] != 'ok':
+                result.update(status=patches[-1]['status'], error=patches[-1].get('error'))
+            elif result['status'] == 'ok' and not outPath:
+                result.update(status='failed', error='The patch failed.')
+            if handle.cancelled:
+                # Cancelled jobs are either stopped with the worker, or already claimed by another one
+                if not stopping.is_set():
+                    printLocked('### Job {} was lost to another worker, whose result is used.'.format(job['id']))
+                continue
+            result.update(seconds=round(time.perf_counter() - startTime, 3), stages=handle.stages)
+            jobQueue.Complete(job['id'], result, outPath if result['status'] in ('ok', 'skipped') else None)
+
+    def renewLeases():
+        while not stopping.wait(leaseTimeout / 4):
+            with lock:
+                leases = list(running.items())
+            for jobId, (attempt, handle) in leases:
+                if not jobQueue.Renew(jobId, attempt):
+                    handle.Cancel()
+
+    threads = [threading.Thread(target=workStage) for _ in range(jobs)]
+    threads.append(threading.Thread(target=renewLeases))
+    for thread in threads:
+        thread.start()
+    print('### Working on the jobs of {} in {} as {}. Press Ctrl+C to stop.'.format(
+        ', '.join(bySource.keys()), os.path.abspath(queueDir), worker))
+    try:
+        while any(i.is_alive() for i in threads):
+            threads[0].join(1.0)
+    except KeyboardInterrupt:
+        print('### Stopping, the running jobs are handed back to the queue.')
+        stopping.set()
+        with lock:
+            leases = list(running.items())
+        for jobId, (attempt, handle) in leases:
+            handle.Cancel()
+            jobQueue.Expire(jobId, attempt)
+        for thread in threads:
+            thread.join()
+
+def syncMirror(argv):
+    '''Implements the "mirror sync" command, which fills a release mirror from GitHub'''
+    parser = argparse.ArgumentParser(
+        prog='ReVanced Auto Patcher mirror sync',
+        description='Downloads the latest and the default versions of the tools into a release mirror directory, '
+                    'from which --mirror or --offline runs provision the tools without GitHub.')
+    parser.add_argument('directory', help='The mirror directory to fill')
+    parser.add_argument('--patchSrc', action='append', choices=patchSources.keys(), help='A patch source to mirror, may be repeated (default: all)')
+    parser.add_argument('--github-api', default=settings['githubApi'], help='The base URL of the GitHub API to look up tool releases from (default: %(default)s)')
+    parser.add_argument('--github-max-wait', type=int, default=settings['githubMaxWait'], help='The longest wait in seconds for the GitHub rate limit to reset, before failing (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    mirror = ReleaseMirror(args.directory)
+    github = GithubClient(
+        args.github_api, os.path.join(args.directory, '.releases.json'), 0, maxWait=args.github_max_wait)
+    syncs = [(apkmdTool['proj'], 'latest', None, apkmdTool['name_filter'], True)]
+    for source in args.patchSrc or patchSources.keys():
+        for tool in ('cli', 'patches', 'integrations'):
+            if tool in patchSources[source]:
+                data = patchSources[source][tool]
+                for version in sorted({'latest', data['ver']}):
+                    syncs.append((data['proj'], version, data['type'], data.get('name_filter'), False))
+    syncs = sorted(set(syncs), key=str)
+    startTime = time.time()
+    downloaded = failures = 0
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(mirror.Sync, github, *i) for i in syncs]
+        for sync, future in zip(syncs, futures):
+            try:
+                downloaded += future.result()
+            except (RuntimeError, OSError) as e:
+                printLocked('### Failed to mirror the {1} release of {0}: {2}'.format(*sync[:2], e))
+                failures += 1
+    print('### Synchronized {} releases into {}: {:.1f} MiB downloaded in {:.1f}s.'.format(
+        len(syncs) - failures, os.path.abspath(args.directory), downloaded / 2**20, time.time() - startTime))
+    github.PrintBudget()
+    if failures:
+        exit(1)
+
+class Config(argparse.Namespace):
+    '''The options of an AsyncPatcher. They default to the command-line defaults, but the tools, the keystore, the options
+    and the patched APKs are kept in the given directory instead of the script's directory. The options are named like
+    the attributes of the parsed command-line arguments, e.g. toolsDir, patchSrc, jvm_worker, apk_cache_size.'''
+
+    def __init__(self, directory, **options):
+        directory = os.path.abspath(directory)
+        values = vars(makeArgumentParser().parse_args([]))
+        del values['files or apps']
+        values.update(
+            keystore=os.path.join(directory, 'patch.keystore'), optionsDir=directory, outDir=directory,
+            toolsDir=os.path.join(directory, 'tools'))
+        unknown = set(options) - set(values)
+        if unknown:
+            raise TypeError('Unknown options: {}'.format(', '.join(sorted(unknown))))
+        values.update(options)
+        if isinstance(values['patchSrc'], str):
+            values['patchSrc'] = values['patchSrc'].split(',')
+        invalid = [i for i in values['patchSrc'] if i not in patchSources.keys()]
+        if invalid:
+            raise ValueError('Unknown patch sources: {}'.format(', '.join(invalid)))
+        super().__init__(**values)
+        normalizeArgs(self)
+
+class AsyncPatcher:
+    '''Patches apps for asyncio code, so that a long-lived process can serve many patch requests.
+    The tools are provisioned once, then up to config.jobs downloads and patch jobs run at a time on threads.
+    Cancelling a Download or Patch call kills its java and apkmd processes.'''
+
+    def __init__(self, config, downloader = True):
+        self.config = config
+        self.downloader = downloader
+        self.report = RunReport(keepStages=False)
+        self.patchers = None
+        self.starting = None
+        self.slots = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(config.jobs + 1, thread_name_prefix='patch')
+
+    async def Start(self):
+        '''Checks java and provisions the tools of the patch sources, unless it is already done.
+        Raises RuntimeError if it fails.'''
+        if self.starting is None:
+            self.starting = asyncio.ensure_future(self.__start())
+        await asyncio.shield(self.starting)
+
+    async def Download(self, app, version = None, directory = None, patchSrc = None):
+        '''Downloads an app, by default in the newest version supported by the patch source, into the directory
+        (by default the output directory). Returns a result with the path of the downloaded APK.'''
+        if app not in appMap.keys():
+            raise ValueError('Unknown app: {}'.format(app))
+        def download(patcher):
+            appVer = version or patcher.ResolveVersion(app)
+            apkPath = patcher.DownloadVersion(app, appVer)
+            if not apkPath:
+                raise RuntimeError('The download of {} failed.'.format(app))
+            try:
+                targetPath = os.path.join(directory or self.config.outDir, os.path.basename(apkPath))
+                shutil.copyfile(apkPath, targetPath)
+            finally:
+                patcher.ReleaseDownload(apkPath)
+            return targetPath
+        return await self.__run(app, patchSrc, download)
+
+    async def Patch(self, source, patchSrc = None, forwardedArgs = []):
+        '''Patches an APK file, or downloads and patches an app if the source is an app name.
+        Returns a result with the path of the patched APK.'''
+        def patch(patcher):
+            if source not in appMap.keys():
+                return patcher.Patch(source, forwardedArgs=forwardedArgs)
+            apkPath = patcher.DownloadVersion(source, patcher.ResolveVersion(source))
+            if not apkPath:
+                raise RuntimeError('The download of {} failed.'.format(source))
+            return patcher.PatchDownloaded(source, apkPath, forwardedArgs=forwardedArgs)
+        return await self.__run(source, patchSrc, patch)
+
+    async def Close(self):
+        '''Waits for the running jobs, then stops the JVM workers'''
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        for patcher in self.patchers or []:
+            if patcher.jvmWorkers:
+                patcher.jvmWorkers.Close()
+
+    async def __start(self):
+        loop = asyncio.get_running_loop()
+        envCache = EnvironmentCache(os.path.join(self.config.toolsDir, 'environment.json'))
+        if not await loop.run_in_executor(self.executor, Patcher.CheckJava, self.report, envCache):
+            raise RuntimeError('Java is missing or too old.')
+        self.patchers = await loop.run_in_executor(self.executor, makePatchers, self.config, self.report, self.downloader)
+        self.slots = asyncio.Semaphore(self.config.jobs)
+
+    async def __run(self, subject, patchSrc, function):
+        '''Runs the function with the patcher of the patch source as a job, returns its result:
+        input, patchSrc, status (ok, skipped, rejected, failed or error), path, error, seconds and stages'''
+        await self.Start()
+        patcher = next((i for i in self.patchers if i.patchSrc == (patchSrc or self.config.patchSrc[0])), None)
+        if not patcher:
+            raise ValueError('The patch source {} is not configured.'.format(patchSrc))
+        job = Job()
+        result = {'input': subject, 'patchSrc': patcher.patchSrc, 'status': 'ok', 'path': None, 'error': None}
+        async with self.slots:
+            startTime = time.perf_counter()
+            future = asyncio.get_running_loop().run_in_executor(self.executor, job.Run, function, patcher)
+            try:
+                result['path'] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                job.Cancel()
+                # The slot is held until the job's thread stops, which is soon once its processes are killed
+                await asyncio.wait([future])
+                future.exception() # Retrieves the job's error, which is expected once it is cancelled
+                raise
+            except Exception as e:
+                result.update(status='error', error=str(e))
+        patches = [i for i in job.stages if i['stage'] == 'Patch']
+        if result['status'] == 'ok' and patches and patches[-1]['status'] != 'ok':
+            result['status'] = patches[-1]['status']
+            result['error'] = patches[-1].get('error')
+        result.update(seconds=round(time.perf_counter() - startTime, 3), stages=job.stages)
+        return result
+
+def normalizeArgs(args):
+    '''Removes the repeated patch sources, and resolves the default job count'''
+    args.patchSrc = list(dict.fromkeys(args.patchSrc))
+    if args.jobs is None:
+        args.jobs = len(args.patchSrc)
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+
+def makeArgumentParser():
+    '''Returns the parser of the command-line arguments'''
+    def raise_(ex):
+        raise ex
     def argCheck(x):
         arg = next((j for j, l in ((i, i.casefold()) for i in appMap.keys()) if l == x.casefold()), None)
         if not arg: arg = x if os.path.exists(x) else None
@@ -579,27 +3204,130 @@ def main():
     parser.add_argument('--optionsDir', default=os.path.abspath(settings['optionsDir']), help='The directory to store patch options files in (default: %(default)s)')
     parser.add_argument('--outDir', '-o', default=os.path.abspath(settings['outDir']), help='The directory to write patched APKs to (default: %(default)s)')
     parser.add_argument(
-        '--patchSrc', choices=patchSources.keys(), default=settings['defaultPatchSource'],
-        type=lambda x : x if x in patchSources.keys() else raise_(argparse.ArgumentTypeError("invalid version")),
-        help='The patch source to use. Use "rv" for ReVanced and "rvx" for ReVanced Extended (default: %(default)s).')
+        '--patchSrc', default=settings['defaultPatchSource'], metavar='{{{}}}[,...]'.format(','.join(patchSources.keys())),
+        type=lambda x : x.split(',') if all(i in patchSources.keys() for i in x.split(',')) else raise_(argparse.ArgumentTypeError("invalid patch source")),
+        help='The patch source to use. Use "rv" for ReVanced, "rvx" for ReVanced Extended and "morphe" for Morphe. '
+             'Several comma-separated sources patch each app in parallel, downloading it once (default: %(default)s).')
     parser.add_argument('--toolsDir', default=os.path.abspath(settings['toolsDir']), help='The directory to store tools and patches in (default: %(default)s)')
     for tool in Patcher.tools:
         parser.add_argument(
             '--{}-version'.format(tool),
             type=lambda str : str if re.match(r'^latest|v?\d+(?:\.\d+)*(?:-[^ ]+)?$', str) else raise_(argparse.ArgumentTypeError("invalid version")),
-            default=patchSources[settings['defaultPatchSource']][tool]['ver'], help='The tool version to use (default: %(default)s)')
+            help='The tool version to use (default: the version configured for the patch source)')
+    parser.add_argument('--scratch', action='append', metavar='DIR', help='A directory for temporary files, may be repeated with the fastest first. Each job uses the first one with enough free space, then the system temp dir (default: {})'.format(settings['scratchDirs'] or 'the system temp dir'))
+    parser.add_argument('--scratch-multiplier', type=float, default=settings['scratchMultiplier'], help='The free scratch space needed by a patch job, as a multiple of its APK size (default: %(default)s)')
+    parser.add_argument('--github-api', default=settings['githubApi'], help='The base URL of the GitHub API to look up tool releases from (default: %(default)s)')
+    parser.add_argument('--github-max-wait', type=int, default=settings['githubMaxWait'], help='The longest wait in seconds for the GitHub rate limit to reset, before failing. Set the GITHUB_TOKEN environment variable for a higher rate limit (default: %(default)s)')
+    parser.add_argument('--release-cache-ttl', type=int, default=settings['releaseCacheTtl'], help='Seconds for which looked up tool releases are reused without any request (default: %(default)s)')
+    parser.add_argument('--mirror', default=settings['mirror'], help='A release mirror directory, filled by "patch.py mirror sync DIR", to provision the tools from instead of GitHub')
+    parser.add_argument('--offline', action='store_true', help='Provision the tools from the mirror, or the tool store and the cached releases, without any network access')
+    parser.add_argument('--refresh-tools', action='store_true', help='Revalidate the cached tool releases with GitHub, regardless of their age')
+    parser.add_argument('--jvm-worker', action='store_true', default=settings['jvmWorker'], help='Run the patch tools in resident JVMs to avoid the java startup cost of each call. '
+                        'Their heap is not limited to the memory budget of the concurrent jobs, which is still reserved')
+    parser.add_argument('--arch', default=settings['download']['arch'], help='The architecture of downloaded APKs, unless the app has a single one: armeabi-v7a, arm64-v8a, x86 or x86_64 (default: %(default)s)')
+    parser.add_argument('--dpi', default=settings['download']['dpi'], help='The DPI of downloaded APKs: nodpi, 240dpi, 320dpi, ... (default: %(default)s)')
+    parser.add_argument('--apk-cache', default=settings['apkCache'], help='The directory to keep downloaded APKs in (default: the "apks" subdirectory of the tools directory)')
+    parser.add_argument('--apk-cache-size', type=int, default=settings['apkCacheSize'], help='The disk budget of the downloaded APK cache in MiB, 0 disables the cache (default: %(default)s)')
+    parser.add_argument('--tool-store-size', type=int, default=settings['toolStoreSize'], help='The disk budget of the tool store in MiB, which keeps all downloaded tool versions (default: %(default)s)')
+    parser.add_argument('--gc-tools', action='store_true', help='Remove the least recently used tool versions from the tool store until it fits its budget, then exit')
+    parser.add_argument('--cache-stats', action='store_true', help='Show the contents of the downloaded APK cache, then exit')
+    parser.add_argument('--no-preflight', action='store_false', dest='preflight', default=settings['preflight'], help='Patch local APKs without checking their package and version against the patches first')
+    parser.add_argument('--force', '-f', action='store_true', help='Patch the APKs even if their outputs are up to date')
+    parser.add_argument('--timing', action='store_true', help='Show how long the startup took until the first patch job')
+    parser.add_argument('--report', help='Write a JSON report of the time and resources used by each stage of the run to this path')
+    parser.add_argument(
+        '--watch', nargs='?', const=os.path.abspath(settings['srcDir']), metavar='DIR',
+        help='Stay resident and patch the APKs added to or changed in the directory, instead of the given inputs (default: %(const)s)')
+    parser.add_argument('--watch-settle', type=float, default=settings['watchSettle'], help='Seconds for which a watched APK must stay unchanged before it is patched (default: %(default)s)')
+    parser.add_argument('--watch-poll-interval', type=float, default=settings['watchPollInterval'], help='Seconds between directory scans when inotify is unavailable (default: %(default)s)')
+    parser.add_argument('--coordinate', metavar='QUEUE', help='Publish the patch jobs of the inputs to a queue directory shared with --work processes, possibly on other hosts, and collect their outputs')
+    parser.add_argument('--work', metavar='QUEUE', help='Stay resident and run the jobs of the selected patch sources from a queue directory, with up to --jobs at a time')
+    parser.add_argument('--lease-timeout', type=float, default=settings['leaseTimeout'], help='Seconds without a heartbeat after which a queued job of a dead worker is retried (default: %(default)s)')
+    parser.add_argument('--queue-poll-interval', type=float, default=settings['queuePollInterval'], help='Seconds between the queue scans of the coordinator and the idle workers (default: %(default)s)')
+    parser.add_argument('--compare-report', metavar='REPORT', help='Show the patches and phases which got slower than in an earlier --report file')
+    parser.add_argument('--list-supported', action='store_true', help='List the apps and versions supported by the patches, then exit')
+    parser.add_argument(
+        '--jobs', '-j',
+        type=lambda x : int(x) if x.isdigit() else raise_(argparse.ArgumentTypeError("invalid job count")),
+        help='The maximum number of concurrent patch jobs, 0 for one per CPU. Above 1, downloads and version lookups overlap with patching, '
+             'and jobs are only started while their estimated memory is available, with their java heap limited to it (default: 1, or the number of patch sources)')
+    parser.add_argument('--memory-estimate', type=int, default=settings['memoryEstimate'], help='MiB of peak memory assumed for patching an app that was not patched before (default: %(default)s)')
+    parser.add_argument('--memory-reserve', type=int, default=settings['memoryReserve'], help='MiB of available memory left to the system by concurrent patch jobs (default: %(default)s)')
     parser.add_argument('--exclusive', '--enable', '-e', '-ei', '--disable', '-d', '-di', '--options', '-O', action=ForwardedArg, default=[], dest='forwarded_args', help='ReVanced patch control options. See revanced-cli docs for more info.')
-    args = parser.parse_args()
+    return parser
 
-    if not Patcher.CheckJava():
+def main():
+    if sys.argv[1:3] == ['mirror', 'sync']:
+        syncMirror(sys.argv[3:])
+        return
+    args = makeArgumentParser().parse_args()
+    normalizeArgs(args)
+    if args.gc_tools:
+        toolStore = ToolStore(os.path.join(args.toolsDir, 'store'), args.tool_store_size << 20)
+        count, size = toolStore.Collect()
+        print('### Removed {} unused tool assets, {:.1f} MiB.'.format(count, size / 2**20))
+        toolStore.PrintStats()
+        exit(0)
+    if args.cache_stats:
+        if args.apk_cache_size > 0:
+            ApkCache(args.apk_cache if args.apk_cache else os.path.join(args.toolsDir, 'apks'),
+                     args.apk_cache_size << 20).PrintStats()
+        else:
+            print('### The downloaded APK cache is disabled.')
+        exit(0)
+
+    report = RunReport(maxStages=RunReport.longRunStages if args.watch or args.work else None)
+    if not Patcher.CheckJava(report, EnvironmentCache(os.path.join(args.toolsDir, 'environment.json'))):
         exit(1)
 
-    patcher = makePatcher(args)
-    for path in getattr(args, 'files or apps'):
-        if path in appMap.keys():
-            patcher.DownloadAndPatch(path, forwardedArgs=args.forwarded_args)
-        else:
-            patcher.Patch(path, forwardedArgs=args.forwarded_args)
+    try:
+        patchers = makePatchers(
+            args, report, downloader=not (args.watch or args.coordinate or args.work) and
+            any(i in appMap.keys() for i in getattr(args, 'files or apps')))
+    except (RuntimeError, OSError) as e:
+        print('### Error: Could not provision the tools: {}'.format(e))
+        exit(2)
+    if args.list_supported:
+        for patcher in patchers:
+            if len(patchers) > 1:
+                print('### {}:'.format(patcher.patchSrc))
+            patcher.ListSupported()
+        exit(0)
+    failures = 0
+    if args.work:
+        workQueue(patchers, args.work, args.jobs, args.lease_timeout, args.queue_poll_interval)
+    elif args.coordinate:
+        failures = coordinateQueue(
+            patchers, args.coordinate, getattr(args, 'files or apps'), args.forwarded_args, args.outDir,
+            args.lease_timeout, args.queue_poll_interval)
+    elif args.watch:
+        watchDirectory(
+            patchers, args.watch, args.forwarded_args, args.jobs, args.watch_settle, args.watch_poll_interval,
+            report, args.report)
+    elif args.jobs > 1 or len(patchers) > 1:
+        failures = runPipeline(patchers, getattr(args, 'files or apps'), args.forwarded_args, args.jobs)
+    else:
+        patcher = patchers[0]
+        # Download all requested apps with one apkmd call before patching
+        downloads = patcher.DownloadMany([i for i in getattr(args, 'files or apps') if i in appMap.keys()])
+        for path in getattr(args, 'files or apps'):
+            if path in appMap.keys():
+                if downloads.get(path):
+                    patcher.PatchDownloaded(path, downloads.pop(path), forwardedArgs=args.forwarded_args)
+            else:
+                patcher.Patch(path, forwardedArgs=args.forwarded_args)
+    if isinstance(patchers[0].github, GithubClient):
+        patchers[0].github.PrintBudget()
+        report.counters['github'] = patchers[0].github.Budget()
+    if args.timing:
+        report.PrintStartup()
+    if args.compare_report:
+        report.PrintComparison(args.compare_report)
+    if args.report:
+        report.PrintSummary()
+        report.Write(args.report)
+    if failures:
+        exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,164 @@
+'''Tests of the binary AndroidManifest.xml decoder and the preflight check built on it'''
+
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import patch
+
+VERSION_NAME_ID = 0x0101021c
+VERSION_CODE_ID = 0x0101021b
+
+def stringPool(strings, utf8):
+    '''Returns a string pool chunk of the strings, in UTF-8 or UTF-16'''
+    offsets = []
+    body = b''
+    for string in strings:
+        offsets.append(len(body))
+        if utf8:
+            encoded = string.encode('utf-8')
+            # The UTF-16 and the byte lengths, each in 1 byte, or in 2 bytes with the high bit set
+            for length in (len(string), len(encoded)):
+                body += bytes([0x80 | length >> 8, length & 0xFF]) if length > 0x7F else bytes([length])
+            body += encoded + b'\0'
+        else:
+            body += struct.pack('<H', len(string)) + string.encode('utf-16-le') + b'\0\0'
+    body += b'\0' * (-len(body) % 4)
+    headerSize = 28
+    header = struct.pack('<IIIII', len(strings), 0, 0x100 if utf8 else 0, headerSize + 4 * len(strings), 0)
+    data = header + b''.join(struct.pack('<I', i) for i in offsets) + body
+    return struct.pack('<HHI', 0x0001, headerSize, 8 + len(data)) + data
+
+def binaryManifest(package, version, utf8 = False, obfuscated = False, reference = False):
+    '''Returns a binary manifest with a <manifest> element of the package and version name.
+    An obfuscated manifest renames the versionName attribute, a reference version points to a resource.'''
+    strings = [
+        'vn' if obfuscated else 'versionName', 'versionCode', 'package', 'manifest',
+        'http://schemas.android.com/apk/res/android', package, version]
+    ids = struct.pack('<II', VERSION_NAME_ID, VERSION_CODE_ID)
+    resourceMap = struct.pack('<HHI', 0x0180, 8, 8 + len(ids)) + ids
+    # Namespace, name, raw value, data type and data of each attribute
+    versionAttribute = (4, 0, 0xFFFFFFFF, 0x01, 0x7F010001) if reference else (4, 0, 6, 0x03, 6)
+    attributes = [versionAttribute, (4, 1, 0xFFFFFFFF, 0x10, 42), (0xFFFFFFFF, 2, 5, 0x03, 5)]
+    attributeData = b''.join(
+        struct.pack('<IIIHBBI', namespace, name, raw, 8, 0, dataType, value)
+        for namespace, name, raw, dataType, value in attributes)
+    element = struct.pack('<II', 1, 0xFFFFFFFF)
+    element += struct.pack('<IIHHHHHH', 0xFFFFFFFF, 3, 20, 20, len(attributes), 0, 0, 0) + attributeData
+    element = struct.pack('<HHI', 0x0102, 16, 8 + len(element)) + element
+    body = stringPool(strings, utf8) + resourceMap + element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+class ApkTestCase(unittest.TestCase):
+    '''Writes the test APKs into a temporary directory'''
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def writeApk(self, manifest):
+        path = os.path.join(self.directory.name, 'app.apk')
+        with zipfile.ZipFile(path, 'w') as apk:
+            apk.writestr('classes.dex', b'dex')
+            apk.writestr('AndroidManifest.xml', manifest)
+        return path
+
+class ReadApkManifestTest(ApkTestCase):
+    def testUtf16Pool(self):
+        path = self.writeApk(binaryManifest('com.google.android.youtube', '19.25.37'))
+        self.assertEqual(patch.readApkManifest(path), ('com.google.android.youtube', '19.25.37'))
+
+    def testUtf8Pool(self):
+        path = self.writeApk(binaryManifest('com.example.app', '1.0-bêta', utf8=True))
+        self.assertEqual(patch.readApkManifest(path), ('com.example.app', '1.0-bêta'))
+
+    def testUtf8PoolWithLongStrings(self):
+        package = 'com.example.' + 'a' * 200
+        path = self.writeApk(binaryManifest(package, '2.0', utf8=True))
+        self.assertEqual(patch.readApkManifest(path), (package, '2.0'))
+
+    def testObfuscatedAttributeName(self):
+        path = self.writeApk(binaryManifest('com.example.app', '3.1', obfuscated=True))
+        self.assertEqual(patch.readApkManifest(path), ('com.example.app', '3.1'))
+
+    def testReferenceVersion(self):
+        for utf8 in (False, True):
+            path = self.writeApk(binaryManifest('com.example.app', '3.1', utf8=utf8, reference=True))
+            self.assertEqual(patch.readApkManifest(path), ('com.example.app', None))
+
+    def testTextManifest(self):
+        path = self.writeApk(b'<manifest package="com.example.app"/>')
+        with self.assertRaises(ValueError):
+            patch.readApkManifest(path)
+
+    def testNotAZip(self):
+        path = os.path.join(self.directory.name, 'app.apk')
+        with open(path, 'wb') as file:
+            file.write(b'not a zip')
+        with self.assertRaises(zipfile.BadZipFile):
+            patch.readApkManifest(path)
+
+class PreflightTest(ApkTestCase):
+    def makePatcher(self, supported):
+        patcher = patch.Patcher.__new__(patch.Patcher)
+        patcher.patchSrc = 'rv'
+        patcher.report = patch.RunReport()
+        patcher.GetSupportedApps = supported
+        return patcher
+
+    def testSupportedVersion(self):
+        path = self.writeApk(binaryManifest('com.example.app', '1.0'))
+        patcher = self.makePatcher(lambda: {'com.example.app': ['1.0']})
+        self.assertEqual(patcher.Preflight(path), 'com.example.app')
+
+    def testUnsupportedVersion(self):
+        path = self.writeApk(binaryManifest('com.example.app', '0.9'))
+        patcher = self.makePatcher(lambda: {'com.example.app': ['1.0']})
+        with self.assertRaises(RuntimeError):
+            patcher.Preflight(path)
+
+    def testUnsupportedPackage(self):
+        path = self.writeApk(binaryManifest('com.example.other', '1.0'))
+        patcher = self.makePatcher(lambda: {'com.example.app': []})
+        with self.assertRaises(RuntimeError):
+            patcher.Preflight(path)
+
+    def testReferenceVersionIsUnchecked(self):
+        path = self.writeApk(binaryManifest('com.example.app', '1.0', reference=True))
+        patcher = self.makePatcher(lambda: {'com.example.app': ['1.0']})
+        self.assertEqual(patcher.Preflight(path), 'com.example.app')
+
+    def testFailingListPatchesIsUnchecked(self):
+        def supported():
+            raise subprocess.CalledProcessError(1, ['list-patches'])
+        path = self.writeApk(binaryManifest('com.example.app', '1.0'))
+        self.assertEqual(self.makePatcher(supported).Preflight(path), 'com.example.app')
+
+class OptionsFileNameTest(ApkTestCase):
+    def optionsFileName(self, srcFile, package):
+        patcher = patch.Patcher.__new__(patch.Patcher)
+        patcher.optionsDir = self.directory.name
+        return patcher._Patcher__optionsFileName(srcFile, package)
+
+    def testPackageName(self):
+        self.assertEqual(self.optionsFileName('YouTube 19.1.apk', 'com.google.android.youtube'), 'Youtube.json')
+        self.assertEqual(self.optionsFileName('Foo 1.0.apk', 'com.foo'), 'com.foo.json')
+
+    def testUnknownPackage(self):
+        self.assertEqual(self.optionsFileName('Foo 1.0.apk', None), 'Foo.json')
+
+    def testExistingFileNameOptions(self):
+        open(os.path.join(self.directory.name, 'YouTube.json'), 'w').close()
+        self.assertEqual(self.optionsFileName('YouTube 19.1.apk', 'com.google.android.youtube'), 'YouTube.json')
+        open(os.path.join(self.directory.name, 'Youtube.json'), 'w').close()
+        self.assertEqual(self.optionsFileName('YouTube 19.1.apk', 'com.google.android.youtube'), 'Youtube.json')
+
+if __name__ == '__main__':
+    unittest.main()
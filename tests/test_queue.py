@@ -0,0 +1,122 @@
+'''Tests of the shared directory job queue with several worker processes'''
+
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import patch
+
+LEASE_TIMEOUT = 1.0
+
+# A worker which claims one job, and either hangs without renewing its lease, or completes it with an output
+WORKER = textwrap.dedent('''
+    import os, sys, time
+    sys.path.insert(0, {root!r})
+    import patch
+    queueDir, name, hang = sys.argv[1:]
+    jobQueue = patch.JobQueue(queueDir, {leaseTimeout!r})
+    claim = None
+    while not claim:
+        claim = jobQueue.Claim(name, ['rv'])
+        time.sleep(0.05)
+    job, attempt = claim
+    print(job['id'], attempt, flush=True)
+    if hang == '1':
+        time.sleep(60)
+    outPath = os.path.join(queueDir, name + '.apk')
+    with open(outPath, 'w') as file:
+        file.write(name)
+    jobQueue.Complete(job['id'], {{'status': 'ok', 'worker': name, 'attempt': attempt}}, outPath)
+''').format(root=ROOT, leaseTimeout=LEASE_TIMEOUT)
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.queue = patch.JobQueue(self.directory.name, LEASE_TIMEOUT)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.wait()
+            worker.stdout.close()
+        self.directory.cleanup()
+
+    def startWorker(self, name, hang = False):
+        worker = subprocess.Popen(
+            [sys.executable, '-c', WORKER, self.directory.name, name, '1' if hang else '0'],
+            stdout=subprocess.PIPE, text=True)
+        self.workers.append(worker)
+        return worker
+
+    def claimed(self, worker):
+        line = worker.stdout.readline()
+        while line.startswith('###'):
+            line = worker.stdout.readline()
+        jobId, attempt = line.split()
+        return jobId, int(attempt)
+
+    def waitForResult(self, jobId):
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            result = self.queue.Result(jobId)
+            if result:
+                return result
+            time.sleep(0.05)
+        self.fail('The job {} did not finish.'.format(jobId))
+
+    def readOutput(self, jobId, result):
+        with open(self.queue.OutputPath(jobId, result['attempt'])) as file:
+            return file.read()
+
+    def testWorkersClaimDifferentJobs(self):
+        jobIds = {self.queue.Publish({'app': 'Youtube', 'patchSrc': 'rv'}) for _ in range(2)}
+        first, second = self.startWorker('first'), self.startWorker('second')
+        self.assertEqual({self.claimed(first)[0], self.claimed(second)[0]}, jobIds)
+        for jobId in jobIds:
+            result = self.waitForResult(jobId)
+            self.assertEqual(result['attempt'], 1)
+            self.assertEqual(self.readOutput(jobId, result), result['worker'])
+
+    def testRetryAfterKilledWorker(self):
+        jobId = self.queue.Publish({'app': 'Youtube', 'patchSrc': 'rv'})
+        killed = self.startWorker('killed', hang=True)
+        self.assertEqual(self.claimed(killed), (jobId, 1))
+        killed.kill()
+        killedTime = time.time()
+        retry = self.startWorker('retry')
+        self.assertEqual(self.claimed(retry), (jobId, 2))
+        # The job is only claimed again once the lease of the killed worker expired
+        self.assertGreaterEqual(time.time() - killedTime, LEASE_TIMEOUT * 0.9)
+        result = self.waitForResult(jobId)
+        self.assertEqual((result['worker'], result['attempt']), ('retry', 2))
+        self.assertEqual(self.readOutput(jobId, result), 'retry')
+
+    def testLateAttemptKeepsFirstResult(self):
+        jobId = self.queue.Publish({'app': 'Youtube', 'patchSrc': 'rv'})
+        outPath = os.path.join(self.directory.name, 'late.apk')
+        with open(outPath, 'w') as file:
+            file.write('late')
+        self.assertTrue(self.queue.Complete(jobId, {'status': 'ok', 'worker': 'first', 'attempt': 2}))
+        self.assertFalse(self.queue.Complete(jobId, {'status': 'ok', 'worker': 'late', 'attempt': 1}, outPath))
+        self.assertEqual(self.queue.Result(jobId)['worker'], 'first')
+        self.assertEqual(os.listdir(os.path.join(self.directory.name, 'outputs')), [])
+
+    def testCompleteAfterRemove(self):
+        jobId = self.queue.Publish({'app': 'Youtube', 'patchSrc': 'rv'})
+        self.queue.Remove(jobId)
+        outPath = os.path.join(self.directory.name, 'late.apk')
+        with open(outPath, 'w') as file:
+            file.write('late')
+        self.assertFalse(self.queue.Complete(jobId, {'status': 'ok', 'worker': 'late', 'attempt': 1}, outPath))
+        self.assertEqual(os.listdir(os.path.join(self.directory.name, 'outputs')), [])
+        self.assertIsNone(self.queue.Result(jobId))
+
+if __name__ == '__main__':
+    unittest.main()